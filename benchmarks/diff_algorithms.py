@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wit_consts import DIFF_ALGORITHMS, DIFFLIB  # noqa: E402
+from wit_diff_algorithms import unified_diff  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 50000, 100000]
+# A change rate of 1 regenerates the whole file, the way a rewritten export or build output changes
+DEFAULT_CHANGE_RATES = [0.01, 0.5, 1.0]
+REPEATING_ROWS = "repeating"
+UNIQUE_ROWS = "unique"
+ROW_KINDS = [REPEATING_ROWS, UNIQUE_ROWS]
+# difflib gets close to quadratic on repetitive input, larger files are skipped unless asked for
+DEFAULT_DIFFLIB_MAXIMUM_SIZE = 50000
+
+
+def generate_row(random_generator: random.Random, row_kind: str, row_number: int) -> str:
+    # Repeating rows share a handful of values, like generated CSVs and logs, unique rows are all different
+    if REPEATING_ROWS == row_kind:
+        return f"{random_generator.randrange(100)},{random_generator.choice(['ok', 'error', 'retry'])}," \
+               f"{random_generator.randrange(10)}\n"
+    return f"{row_number},{random_generator.getrandbits(64):x}\n"
+
+
+def generate_lines(line_count: int, change_rate: float, row_kind: str, seed: int) -> Tuple[List[str], List[str]]:
+    random_generator = random.Random(seed)
+    old_lines = [generate_row(random_generator, row_kind, i) for i in range(line_count)]
+    if change_rate >= 1:
+        return old_lines, [generate_row(random_generator, row_kind, i) for i in range(line_count)]
+    new_lines = []
+    for i, line in enumerate(old_lines):
+        dice = random_generator.random()
+        if dice < change_rate / 3:
+            continue
+        elif dice < 2 * change_rate / 3:
+            new_lines.append(generate_row(random_generator, row_kind, i))
+            new_lines.append(line)
+        elif dice < change_rate:
+            new_lines.append(generate_row(random_generator, row_kind, i))
+        else:
+            new_lines.append(line)
+    return old_lines, new_lines
+
+
+def measure(old_lines: List[str], new_lines: List[str], algorithm: str) -> Tuple[float, int]:
+    start = time.perf_counter()
+    changed_line_count = sum(1 for line in unified_diff(old_lines, new_lines, "old", "new", algorithm=algorithm)
+                             if line[0] in "+-" and not line.startswith(("+++", "---")))
+    return time.perf_counter() - start, changed_line_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the diff algorithms of wit on generated files")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="line counts to measure")
+    parser.add_argument("--change-rates", type=float, nargs="+", default=DEFAULT_CHANGE_RATES,
+                        help="fractions of lines that are changed, 1 rewrites the whole file")
+    parser.add_argument("--row-kinds", choices=ROW_KINDS, nargs="+", default=ROW_KINDS,
+                        help="whether lines repeat a few values or are all different")
+    parser.add_argument("--difflib-maximum-size", type=int, default=DEFAULT_DIFFLIB_MAXIMUM_SIZE,
+                        help="largest line count measured with difflib")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    print(f"{'rows':>10} {'change':>7} {'lines':>10} {'algorithm':>10} {'seconds':>10} {'changed lines':>14}")
+    for row_kind in arguments.row_kinds:
+        for change_rate in arguments.change_rates:
+            for size in arguments.sizes:
+                old_lines, new_lines = generate_lines(size, change_rate, row_kind, arguments.seed)
+                for algorithm in DIFF_ALGORITHMS:
+                    prefix = f"{row_kind:>10} {change_rate:>7.2f} {size:>10} {algorithm:>10}"
+                    if DIFFLIB == algorithm and size > arguments.difflib_maximum_size:
+                        print(f"{prefix} {'skipped':>10}")
+                        continue
+                    seconds, changed_line_count = measure(old_lines, new_lines, algorithm)
+                    print(f"{prefix} {seconds:>10.3f} {changed_line_count:>14}")
+
+
+if __name__ == '__main__':
+    main()
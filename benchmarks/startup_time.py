@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Set, Tuple
+
+WIT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "wit.py")
+
+DEFAULT_RUNS = 20
+# Commands that scripts run most, with the modules that only other commands need and that must stay out of them
+COMMANDS = [
+    (["status"], {"graphviz", "dateutil", "multiprocessing", "concurrent.futures", "difflib", "ctypes"}),
+    (["add", "a.txt"], {"graphviz", "dateutil", "multiprocessing", "difflib", "ctypes"}),
+    (["diff"], {"graphviz", "dateutil", "multiprocessing", "ctypes"}),
+]  # type: List[Tuple[List[str], Set[str]]]
+
+
+def run_wit(repository_path: str, command: List[str], *python_options: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *python_options, WIT_PATH, *command], cwd=repository_path,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def create_repository(repository_path: str):
+    run_wit(repository_path, ["init"])
+    os.makedirs(os.path.join(repository_path, "d"))
+    for relative_path in ["a.txt", os.path.join("d", "b.txt")]:
+        with open(os.path.join(repository_path, relative_path), "w") as f:
+            f.write(f"{relative_path}\n")
+    run_wit(repository_path, ["add", "."])
+    run_wit(repository_path, ["commit", "first"])
+
+
+def get_import_times(repository_path: str, command: List[str]) -> Dict[str, int]:
+    # Lines of '-X importtime' look like 'import time: <self us> | <cumulative us> | <indented module name>'
+    import_times = {}
+    for line in run_wit(repository_path, command, "-X", "importtime").stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if fields[0].strip().isdigit():
+            import_times[fields[2].strip()] = int(fields[0])
+    return import_times
+
+
+def measure(repository_path: str, python_arguments: List[str], runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *python_arguments], cwd=repository_path, stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the startup of common wit commands and check that modules of "
+                                                 "other commands are not imported by them")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="runs per command, the median is shown")
+    arguments = parser.parse_args()
+
+    regressions = []
+    with tempfile.TemporaryDirectory() as repository_path:
+        create_repository(repository_path)
+        # An empty interpreter is the floor no command can get under
+        baseline = measure(repository_path, ["-c", "pass"], arguments.runs)
+
+        print(f"{'command':>12} {'wall ms':>10} {'imports ms':>11} {'modules':>8}  unexpected imports")
+        print(f"{'python':>12} {baseline * 1000:>10.1f}")
+        for command, unexpected_modules in COMMANDS:
+            import_times = get_import_times(repository_path, command)
+            imported_unexpected = sorted(name for name in import_times if name in unexpected_modules)
+            wall_time = measure(repository_path, [WIT_PATH, *command], arguments.runs)
+            print(f"{' '.join(command):>12} {wall_time * 1000:>10.1f} {sum(import_times.values()) / 1000:>11.1f} "
+                  f"{len(import_times):>8}  {', '.join(imported_unexpected) or '-'}")
+            if imported_unexpected:
+                regressions.append(command[0])
+    if regressions:
+        print(f"Modules of other commands are imported by: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
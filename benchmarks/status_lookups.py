@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Set
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wit_compare import WitEntry, WitIndexSource, WitSource  # noqa: E402
+from wit_index import WitIndex  # noqa: E402
+from wit_objects import FILE_MODE, WitObjectStore, WitTree  # noqa: E402
+from wit_status import WitStatus  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+# Looking paths up in the untracked list is quadratic, larger sizes are skipped unless asked for
+DEFAULT_LIST_MAXIMUM_SIZE = 10000
+FILES_PER_DIRECTORY = 1000
+
+
+class MemoryWorkingDirectorySource(WitSource):
+    def __init__(self, files: Dict[str, str]):
+        self.directories = {"": {}}  # type: Dict[str, Dict[str, WitEntry]]
+        for path, object_id in files.items():
+            directory, name = os.path.split(path)
+            if directory not in self.directories:
+                self.directories[directory] = {}
+                self.directories[""][directory] = WitEntry(directory, True)
+            self.directories[directory][name] = WitEntry(name, False, FILE_MODE, object_id)
+
+    def scan(self, relative_directory: str) -> List[WitEntry]:
+        entries = self.directories.get(relative_directory, {})
+        return [entries[name] for name in sorted(entries)]
+
+
+class MemoryStagingArea(object):
+    def __init__(self, index: WitIndex, store: WitObjectStore, working_directory_files: Dict[str, str]):
+        self.index = index
+        self.store = store
+        self.working_directory_files = working_directory_files
+
+    def get_source(self) -> WitIndexSource:
+        return WitIndexSource(self.index, self.store)
+
+    def get_working_directory_source(self, dirty_paths: Optional[Set[str]] = None) -> MemoryWorkingDirectorySource:
+        return MemoryWorkingDirectorySource(self.working_directory_files)
+
+    def query_fsmonitor(self) -> None:
+        # No file system monitor, every status compares the whole working directory
+        return None
+
+    def save_index(self):
+        pass
+
+
+class MemoryCommit(object):
+    def __init__(self, tree: WitTree):
+        self.commit_id = tree.tree_id
+        self.tree = tree
+
+    def get_tree(self) -> WitTree:
+        return self.tree
+
+
+def get_path(prefix: str, i: int) -> str:
+    return os.path.join(f"{prefix}{i // FILES_PER_DIRECTORY}", f"{i}.txt")
+
+
+def measure(path_count: int, is_list_measured: bool) -> List[float]:
+    # Every tracked file is modified in the working directory and as many untracked files lie next to them, which is
+    # what checkout sees when it overwrites a whole tree
+    with tempfile.TemporaryDirectory() as temp_path:
+        store = WitObjectStore(temp_path)
+        index = WitIndex(os.path.join(temp_path, "index"))
+        working_directory_files = {}
+        for i in range(path_count):
+            tracked_path = get_path("tracked", i)
+            index.update(tracked_path, WitObjectStore.hash_bytes("blob", f"staged {i}".encode()))
+            working_directory_files[tracked_path] = WitObjectStore.hash_bytes("blob", f"modified {i}".encode())
+            working_directory_files[get_path("untracked", i)] = WitObjectStore.hash_bytes("blob", f"{i}".encode())
+        head_commit = MemoryCommit(index.get_tree(store))
+        tracked_paths = list(index.entries)
+
+        start = time.perf_counter()
+        status = WitStatus(head_commit, MemoryStagingArea(index, store, working_directory_files), store)
+        timings = [time.perf_counter() - start]
+
+        start = time.perf_counter()
+        for path in tracked_paths:
+            status.is_untracked(path)
+            status.is_missing(path)
+        timings.append(time.perf_counter() - start)
+
+        if is_list_measured:
+            start = time.perf_counter()
+            for path in tracked_paths:
+                _ = path in status.untracked_files
+                _ = path in status.missing_files
+            timings.append(time.perf_counter() - start)
+        return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time status and the path lookups checkout makes for every file")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="numbers of paths to measure")
+    parser.add_argument("--list-maximum-size", type=int, default=DEFAULT_LIST_MAXIMUM_SIZE,
+                        help="largest number of paths measured with list lookups")
+    arguments = parser.parse_args()
+
+    print(f"{'paths':>10} {'status':>10} {'lookups':>10} {'list lookups':>13} {'us per path':>12}")
+    for path_count in arguments.sizes:
+        timings = measure(path_count, path_count <= arguments.list_maximum_size)
+        list_timing = f"{timings[2]:>13.3f}" if 3 == len(timings) else f"{'skipped':>13}"
+        print(f"{path_count:>10} {timings[0]:>10.3f} {timings[1]:>10.3f} {list_timing} "
+              f"{(timings[0] + timings[1]) / path_count * 10 ** 6:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,29 @@
 from __future__ import annotations
 
 import os
-from typing import Optional, Set, TYPE_CHECKING
+import shutil
+from typing import Iterable, Iterator, Optional, Set, Tuple, TYPE_CHECKING
 
 from wit_argparse import WitArgparse, WitArguments
-from wit_checkout import WitCheckout
 from wit_classes import ImageDirectory, KeyValueFile
 from wit_commit import WitCommits
-from wit_consts import IMAGES_DIRECTORY_NAME, STAGING_DIRECTORY_NAME, WIT_DIRECTORY_NAME
-from wit_diff import WitDiff
-from wit_exceptions import NonExistingAddTarget, NoWitRootDirectory
-from wit_graph import WitGraph
-from wit_status import WitStatus
-
+from wit_compare import WitFsMonitorWorkingDirectorySource, WitIndexSource, WitWorkingDirectorySource
+from wit_consts import (IMAGES_DIRECTORY_NAME, INDEX_FILE_NAME, LOCK_FILE_NAME, OBJECTS_DIRECTORY_NAME,
+                        STAGING_DIRECTORY_NAME, WIT_DIRECTORY_NAME)
+from wit_exceptions import IgnoredAddTarget, NonExistingAddTarget, NoWitRootDirectory
+from wit_ignore import WitIgnore
+from wit_index import WitIndex
+from wit_lock import WitRepositoryLock
+from wit_objects import get_file_mode, get_object_store, WitObjectStore, WitTree
+from wit_parallel import WitExecutor
+
+# The modules of single commands are imported by the command that uses them, wit is run often enough from scripts
+# that graphviz or multiprocessing showing up in the startup of every command adds up
 if TYPE_CHECKING:
     from wit_commit import WitCommit
+    from wit_fsmonitor import WitFsMonitorResponse
+
+WitStagedFile = Tuple[str, str, str, os.stat_result]  # (relative_path, object_id, mode, file_stat)
 
 
 class WitParentDirectory(ImageDirectory):
@@ -22,38 +31,138 @@ class WitParentDirectory(ImageDirectory):
         super().__init__(wit_parent_directory_path)
 
 
-class WitStagingArea(ImageDirectory):
-    def __init__(self, wit_parent_directory: WitParentDirectory):
+class WitStagingArea(object):
+    # The staging area is the index, a manifest of path, object id and stat data, with the files themselves in the
+    # object store. Repositories made by older versions of wit also have a copy of every staged file under the
+    # staging directory, which is only read to move those files into the object store
+    def __init__(self, wit_parent_directory: WitParentDirectory, objects: WitObjectStore, lock: WitRepositoryLock):
         self.wit_parent_directory = wit_parent_directory
-        path = os.path.join(self.wit_parent_directory.get_path(), WIT_DIRECTORY_NAME, STAGING_DIRECTORY_NAME)
-        super().__init__(path)
+        self.objects = objects
+        self.lock = lock
+        self.legacy_directory_path = os.path.join(self.wit_parent_directory.get_path(), WIT_DIRECTORY_NAME,
+                                                  STAGING_DIRECTORY_NAME)
         self._added_files = set()  # type: Set[str]
+        self.ignore = WitIgnore(self.wit_parent_directory.get_path())
+        self.index = WitIndex(os.path.join(self.wit_parent_directory.get_path(), WIT_DIRECTORY_NAME, INDEX_FILE_NAME))
+        if self.index.exists():
+            self.index.load()
+        else:
+            self._rebuild_index()
+
+    def _rebuild_index(self) -> None:
+        # Repositories created before the index existed only have the staging area files
+        self.index.clear()
+        for curr_dir, _, file_names in os.walk(self.legacy_directory_path):
+            for file_name in file_names:
+                absolute_path = os.path.join(curr_dir, file_name)
+                object_id = WitObjectStore.hash_file(absolute_path)
+                mode = get_file_mode(os.stat(absolute_path))
+                self.index.update(os.path.relpath(absolute_path, self.legacy_directory_path), object_id, mode)
+        self.save_index()
+
+    def save_index(self) -> None:
+        if not self.index.is_dirty:
+            return
+        if self.lock.is_locked():
+            self.index.save()
+        elif self.lock.try_acquire():
+            # Commands that only read the repository run without the lock. What they refreshed is saved only when no
+            # other command holds the lock or wrote the index since it was read, otherwise it is left for later
+            try:
+                if not self.index.is_changed_on_disk():
+                    self.index.save()
+            finally:
+                self.lock.release()
+
+    def has_legacy_directory(self) -> bool:
+        return os.path.isdir(self.legacy_directory_path)
 
     def _get_relative_path_to_wit_root(self, path: str) -> str:
-        return self.get_relative_path(path, self.wit_parent_directory)
+        return self.wit_parent_directory.get_relative_path(path)
 
-    def _copy_to_staging_area(self, relative_path: str) -> None:
-        self.copy_file_from(self.wit_parent_directory, relative_path)
-
-    def _add_file(self, path: str) -> None:
+    def _stage_file(self, path_and_stat: Tuple[str, os.stat_result]) -> Optional[WitStagedFile]:
+        path, file_stat = path_and_stat
         relative_path = self._get_relative_path_to_wit_root(path)
-        self._added_files.add(relative_path)
-        self._copy_to_staging_area(relative_path)
-
-    def _add_directory(self, path: str) -> None:
+        entry = self.index.entries.get(relative_path)
+        if entry is not None:
+            if self.index.is_stat_clean(entry, file_stat):
+                return None
+            if entry.object_id == WitObjectStore.hash_file(path):  # Only the stat data changed
+                return relative_path, entry.object_id, get_file_mode(file_stat), file_stat
+        # Stored right away, there is no copy of it anywhere else for the commit to take it from
+        object_id = self.objects.write_blob_from_file(path)
+        return relative_path, object_id, get_file_mode(file_stat), file_stat
+
+    def _add_files(self, paths: Iterable[Tuple[str, os.stat_result]]) -> None:
+        for staged_file in WitExecutor().map(self._stage_file, paths):
+            if staged_file is not None:
+                relative_path, object_id, mode, file_stat = staged_file
+                self._added_files.add(relative_path)
+                self.index.update(relative_path, object_id, mode, file_stat)
+
+    def _is_tracked(self, relative_path: str) -> bool:
+        return relative_path in self.index.entries or self.index.is_tracked_directory(relative_path)
+
+    def _list_directory_files(self, path: str, relative_path: str,
+                              is_ignored: bool = False) -> Iterator[Tuple[str, os.stat_result]]:
+        # Ignore rules only hide untracked files, tracked ones below an ignored directory are still updated
         if not WIT_DIRECTORY_NAME == os.path.split(path)[1]:  # Skip the '.wit' directory itself
-            for rel_path in os.listdir(path):
-                abs_path = os.path.join(path, rel_path)
-                if os.path.isfile(abs_path):
-                    self._add_file(abs_path)
-                elif os.path.isdir(abs_path):
-                    self._add_directory(abs_path)
+            with os.scandir(path) as it:
+                entries = list(it)
+            for entry in entries:
+                entry_relative_path = os.path.join(relative_path, entry.name)
+                if entry.is_dir():
+                    is_entry_ignored = is_ignored or self.ignore.is_ignored(entry_relative_path, True)
+                    if not is_entry_ignored or self.index.is_tracked_directory(entry_relative_path):
+                        yield from self._list_directory_files(entry.path, entry_relative_path, is_entry_ignored)
+                elif entry.is_file():
+                    if entry_relative_path in self.index.entries \
+                            or not (is_ignored or self.ignore.is_ignored(entry_relative_path, False)):
+                        yield entry.path, entry.stat()
 
     def add(self, absolute_path: str) -> None:
+        relative_path = self._get_relative_path_to_wit_root(absolute_path)
+        if os.curdir == relative_path:
+            relative_path = ""
+        is_directory = os.path.isdir(absolute_path)
+        is_ignored = bool(relative_path) and self.ignore.is_path_ignored(relative_path, is_directory)
+        if is_ignored and not self._is_tracked(relative_path):
+            raise IgnoredAddTarget(relative_path)
         if os.path.isfile(absolute_path):
-            self._add_file(absolute_path)
-        if os.path.isdir(absolute_path):
-            self._add_directory(absolute_path)
+            self._add_files([(absolute_path, os.stat(absolute_path))])
+        if is_directory:
+            self._add_files(self._list_directory_files(absolute_path, relative_path, is_ignored))
+
+    def remove_legacy_directory(self) -> None:
+        # Files staged by older versions of wit may only exist in the staging directory, they are moved into the
+        # object store before it goes away. They were never written in place, so the object can share their inode
+        if not self.has_legacy_directory():
+            return
+        missing_files = [relative_path for relative_path, entry in self.index.entries.items()
+                         if not self.objects.has_object(entry.object_id)]
+        WitExecutor().run(lambda relative_path: self.objects.write_blob_from_file(
+            os.path.join(self.legacy_directory_path, relative_path), allow_hardlink=True), missing_files)
+        shutil.rmtree(self.legacy_directory_path)
+
+    def get_tree(self, store: WitObjectStore, write: bool = False) -> WitTree:
+        return self.index.get_tree(store, write)
+
+    def get_source(self) -> WitIndexSource:
+        return WitIndexSource(self.index, self.objects)
+
+    def get_working_directory_source(self, dirty_paths: Optional[Set[str]] = None) -> WitWorkingDirectorySource:
+        if dirty_paths is not None:
+            return WitFsMonitorWorkingDirectorySource(self.wit_parent_directory.get_path(), self.index, self.ignore,
+                                                      dirty_paths, self.objects)
+        return WitWorkingDirectorySource(self.wit_parent_directory.get_path(), self.index, self.ignore)
+
+    def query_fsmonitor(self) -> Optional[WitFsMonitorResponse]:
+        from wit_fsmonitor import WitFsMonitorClient
+        response = WitFsMonitorClient(self.wit_parent_directory.get_path()).query(self.index.fsmonitor_token)
+        if response is None and self.index.fsmonitor_token is not None:
+            # Without the daemon nothing keeps track of what changes from now on
+            self.index.set_fsmonitor_state(None)
+        return response
 
 
 class WitReferences(KeyValueFile):
@@ -75,14 +184,10 @@ class WitReferences(KeyValueFile):
         return items
 
     def commit(self, commit_id: str):
-        if self.get_head() is None:
-            self.update_head(commit_id)
-            self.update_master(commit_id)
-        elif self.get_head() == self.get_master():
-            self[self.HEAD_KEY] = commit_id
+        # Both references are changed first and written together, once
+        if self.get_head() is None or self.get_head() == self.get_master():
             self[self.MASTER_KEY] = commit_id
-        else:
-            self[self.HEAD_KEY] = commit_id
+        self[self.HEAD_KEY] = commit_id
         self.save()
 
     def get_head(self) -> Optional[str]:
@@ -112,24 +217,39 @@ class Wit(object):
         self.wit_base_directory_path = None  # type: Optional[str]
         self.wit_staging_directory_path = None  # type: Optional[str]
         self.wit_images_directory_path = None  # type: Optional[str]
+        self.wit_objects_directory_path = None  # type: Optional[str]
 
+        self.lock = None  # type: Optional[WitRepositoryLock]
         self.wit_parent_directory = None  # type: WitParentDirectory
         self.references = None  # type: WitReferences
+        self.objects = None  # type: WitObjectStore
         self.commits = None  # type: WitCommits
         self.staging_area = None  # type: WitStagingArea
 
-    def _load(self, path: Optional[str] = None):
+    def _load(self, path: Optional[str] = None, lock: bool = False):
         self.wit_parent_directory_path = self._find_wit_root_directory(path)
         self.wit_base_directory_path = os.path.join(self.wit_parent_directory_path, WIT_DIRECTORY_NAME)
+        self.lock = WitRepositoryLock(os.path.join(self.wit_base_directory_path, LOCK_FILE_NAME))
+        if lock:
+            # Taken before anything is read, so that what a command writes back builds on what the last one wrote
+            self.lock.acquire()
         self.wit_staging_directory_path = os.path.join(self.wit_base_directory_path, STAGING_DIRECTORY_NAME)
         self.wit_images_directory_path = os.path.join(self.wit_base_directory_path, IMAGES_DIRECTORY_NAME)
+        self.wit_objects_directory_path = os.path.join(self.wit_base_directory_path, OBJECTS_DIRECTORY_NAME)
 
         self.wit_parent_directory = WitParentDirectory(self.wit_parent_directory_path)
         self.references = WitReferences(self.wit_base_directory_path)
-        self.commits = WitCommits(self.wit_images_directory_path)
-        self.staging_area = WitStagingArea(self.wit_parent_directory)
+        self.objects = get_object_store(self.wit_objects_directory_path)
+        self.commits = WitCommits(self.wit_images_directory_path, self.objects, self.lock)
+        self.staging_area = WitStagingArea(self.wit_parent_directory, self.objects, self.lock)
+        if lock:
+            self.staging_area.remove_legacy_directory()
         self._is_loaded = True
 
+    def unlock(self):
+        if self.lock is not None:
+            self.lock.release()
+
     def _get_parent_directory(self, current_path: str) -> str:
         return os.path.abspath(os.path.join(current_path, os.path.pardir))
 
@@ -160,7 +280,7 @@ class Wit(object):
     def _create_wit_dir(self, wit_parent_directory: str) -> None:
         os.mkdir(os.path.join(wit_parent_directory, WIT_DIRECTORY_NAME))
         os.mkdir(os.path.join(wit_parent_directory, WIT_DIRECTORY_NAME, IMAGES_DIRECTORY_NAME))
-        os.mkdir(os.path.join(wit_parent_directory, WIT_DIRECTORY_NAME, STAGING_DIRECTORY_NAME))
+        os.mkdir(os.path.join(wit_parent_directory, WIT_DIRECTORY_NAME, OBJECTS_DIRECTORY_NAME))
 
     def init(self) -> None:
         try:
@@ -171,47 +291,91 @@ class Wit(object):
 
     # add related code
     def add(self, arguments: WitArguments) -> None:
-        for path in arguments.add_paths[0]:
-            absolute_path = os.path.abspath(path)
-            if not os.path.exists(absolute_path):
-                raise NonExistingAddTarget()
+        try:
+            for path in arguments.add_paths[0]:
+                absolute_path = os.path.abspath(path)
+                if not os.path.exists(absolute_path):
+                    raise NonExistingAddTarget()
 
-            self._load(absolute_path)
+                if not self._is_loaded:
+                    self._load(absolute_path, lock=True)
 
-            self.staging_area.add(absolute_path)
+                self.staging_area.add(absolute_path)
+        finally:
+            if self._is_loaded:
+                self.staging_area.save_index()
 
     # commit related code
     def commit(self, arguments: WitArguments) -> None:
-        self._load()
+        self._load(lock=True)
 
-        self.commits.commit(arguments.message, self.references, self.staging_area)
+        try:
+            self.commits.commit(arguments.message, self.references, self.staging_area)
+        finally:
+            # Keeps the directory tree ids computed for the commit, so that the next status can skip unchanged ones
+            self.staging_area.save_index()
 
     # status related code
     def status(self) -> None:
-        self._load()
+        from wit_status import WitStatus
+        self._load(lock=True)
 
         head_id = self.references.get_head()
         head_commit = self.commits[head_id]  # type: WitCommit
-        status = WitStatus(head_commit, self.staging_area)
+        status = WitStatus(head_commit, self.staging_area, self.objects)
         status.print_status()
 
     # checkout related code
     def checkout(self, arguments: WitArguments) -> None:
-        self._load()
+        from wit_checkout import WitCheckout
+        self._load(lock=True)
 
         checkout = WitCheckout(self, arguments.commit_name)
         checkout.checkout()
 
+    # fsmonitor related code
+    def fsmonitor(self, arguments: WitArguments) -> None:
+        from wit_fsmonitor import WitFsMonitorClient, WitFsMonitorDaemon
+        self._load()
+
+        if "run" == arguments.fsmonitor_action:
+            WitFsMonitorDaemon(self.wit_parent_directory_path).run()
+        elif "start" == arguments.fsmonitor_action:
+            WitFsMonitorClient(self.wit_parent_directory_path).start()
+        elif "stop" == arguments.fsmonitor_action:
+            WitFsMonitorClient(self.wit_parent_directory_path).stop()
+
+    # gc related code
+    def gc(self) -> None:
+        from wit_gc import WitGc
+        self._load(lock=True)
+
+        WitGc(self).gc()
+
+    # log related code
+    def log(self, arguments: WitArguments) -> None:
+        from wit_log import WitLog
+        self._load()
+
+        WitLog(self).log(arguments)
+
     # graph related code
-    def graph(self) -> None:
+    def graph(self, arguments: WitArguments) -> None:
+        from wit_graph import WitGraph
         self._load()
 
         graph = WitGraph(self)
-        graph.show()
+        graph.show(arguments)
 
     # diff related code
     def diff(self, arguments: WitArguments) -> None:
+        from wit_diff import WitDiff
+        # The lock is not held while the diff is written, a slow reader such as a pager would block every other
+        # command for as long as it stays open
         self._load()
+        if self.staging_area.has_legacy_directory():
+            with self.lock:
+                self.staging_area.remove_legacy_directory()
 
         diff = WitDiff(self)
         diff.diff(arguments)
@@ -222,6 +386,13 @@ def main():
 
     wit = Wit()
 
+    try:
+        _run_command(wit, argument_namespace)
+    finally:
+        wit.unlock()
+
+
+def _run_command(wit: Wit, argument_namespace: WitArguments):
     if "init" == argument_namespace.command:
         wit.init()
     elif "add" == argument_namespace.command:
@@ -233,9 +404,15 @@ def main():
     elif "checkout" == argument_namespace.command:
         wit.checkout(argument_namespace)
     elif "graph" == argument_namespace.command:
-        wit.graph()
+        wit.graph(argument_namespace)
+    elif "log" == argument_namespace.command:
+        wit.log(argument_namespace)
     elif "diff" == argument_namespace.command:
         wit.diff(argument_namespace)
+    elif "fsmonitor" == argument_namespace.command:
+        wit.fsmonitor(argument_namespace)
+    elif argument_namespace.command in ("gc", "repack"):
+        wit.gc()
 
 
 if __name__ == '__main__':
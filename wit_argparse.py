@@ -1,5 +1,7 @@
 import argparse
 
+from wit_consts import DEFAULT_DIFF_ALGORITHM, DIFF_ALGORITHMS, GRAPH_FORMATS, GRAPH_VIEW_FORMAT
+
 
 WitArguments = argparse.Namespace
 
@@ -28,8 +30,27 @@ class WitArgparse(object):
         parser_checkout = subparsers.add_parser("checkout", help="Checkout a specific commit")
         parser_checkout.add_argument("commit_name", help="Branch name or commit id")
 
+        # Create parser for the "log" command
+        parser_log = subparsers.add_parser("log", help="Show the commits leading to HEAD")
+        parser_log.add_argument("-n", "--max-count", type=int, dest="max_count", metavar="number",
+                                help="Show only the last number commits")
+
         # Create parser for the "graph" command
-        subparsers.add_parser("graph", help="Show wit graph")
+        parser_graph = subparsers.add_parser("graph", help="Show wit graph")
+        parser_graph.add_argument("revision_range", nargs="?", metavar="range",
+                                  help="Commit to show the history of, or 'old..new' for the commits new adds to old")
+        parser_graph.add_argument("-n", "--max-count", type=int, dest="max_count", metavar="number",
+                                  help="Show only the last number commits")
+        parser_graph.add_argument("--format", choices=GRAPH_FORMATS, default=GRAPH_VIEW_FORMAT, dest="graph_format",
+                                  help="Open the rendered graph, or write it to stdout as DOT or JSON without layout")
+
+        # Create parser for the "fsmonitor" command
+        parser_fsmonitor = subparsers.add_parser("fsmonitor", help="Track changed files for a faster status")
+        parser_fsmonitor.add_argument("fsmonitor_action", choices=["start", "stop", "run"],
+                                      help="start or stop the background daemon, or run it in the foreground")
+
+        # Create parser for the "gc" command
+        subparsers.add_parser("gc", aliases=["repack"], help="Pack all objects into a single compressed pack file")
 
         # Create parser for the "diff" command
         parser_diff = subparsers.add_parser("diff", help="Show comparison between commits")
@@ -38,6 +59,12 @@ class WitArgparse(object):
                                                         help="Use staging area as base for comparison")
         parser_diff.add_argument("old_commit", nargs="?", metavar="commit",
                                  help="Commit name to compare with")
+        parser_diff.add_argument("--diff-algorithm", choices=DIFF_ALGORITHMS, default=DEFAULT_DIFF_ALGORITHM,
+                                 help="Algorithm used to compare file contents")
+        parser_diff.add_argument("--binary-summary", action="store_true", dest="binary_summary",
+                                 help="Show the size and hash of both versions of changed binary files")
+        parser_diff.add_argument("-j", "--jobs", type=int,
+                                 help="Number of processes that compare files in parallel (default: CPU count)")
         parser_diff_mutual_exclusive_group.add_argument("new_commit", nargs="?", metavar="newer_commit",
                                                         help="Second commit to compare with")
 
@@ -1,12 +1,12 @@
 from __future__ import annotations
 
 import os
-from typing import TYPE_CHECKING
+from typing import List, Optional, TYPE_CHECKING
 
-
-from wit_consts import WIT_DIRECTORY_NAME
-from wit_exceptions import (ChangesNotStagedForCommitCheckoutError, ChangesToBeCommitCheckoutError,
-                            InvalidCheckoutArgument)
+from wit_compare import MODIFIED, WitChange, WitCompare, WitTreeSource
+from wit_exceptions import (AmbiguousCheckoutArgument, ChangesNotStagedForCommitCheckoutError,
+                            ChangesToBeCommitCheckoutError, InvalidCheckoutArgument)
+from wit_parallel import WitExecutor
 from wit_status import WitStatus
 if TYPE_CHECKING:
     from wit import Wit
@@ -18,39 +18,62 @@ class WitCheckout(object):
         self.wit = wit
         self.commit_id = self._handle_argument(argument)
         self.commit = self.wit.commits[self.commit_id]  # type: WitCommit
-        self.image_directory = self.commit.commit_dir
+        self.tree = self.commit.get_tree()
 
     def _handle_argument(self, argument: str) -> str:
         # if argument is a branch name. translate to a commit_id
         if argument in self.wit.references:
             return self.wit.references[argument]
         # otherwise check if it's a valid commit id
-        elif argument in self.wit.commits:
+        if argument in self.wit.commits:
             return argument
-        else:
-            raise InvalidCheckoutArgument()
+        # or the beginning of one
+        commit_ids = self.wit.commits.find_by_prefix(argument)
+        if 0 == len(commit_ids):
+            raise InvalidCheckoutArgument(argument)
+        elif 1 < len(commit_ids):
+            raise AmbiguousCheckoutArgument(", ".join(map(self.wit.commits.get_shortest_unique_prefix, commit_ids)))
+        return commit_ids[0]
+
+    def _get_changes(self, head_commit: WitCommit) -> List[WitChange]:
+        compare = WitCompare(WitTreeSource(head_commit.get_tree()), WitTreeSource(self.tree))
+        return list(compare.changes())
 
-    def _remove_tracked_files(self, status: WitStatus):
-        for curr_dir, _, file_list in os.walk(self.wit.wit_parent_directory.get_path()):
-            for file_name in file_list:
-                absolute_file_path = os.path.join(curr_dir, file_name)
-                relative_file_path = self.wit.wit_parent_directory.get_relative_path(absolute_file_path)
-                if relative_file_path not in status.untracked_files:
-                    if not relative_file_path.startswith(WIT_DIRECTORY_NAME):
-                        self.wit.wit_parent_directory.remove_file(relative_file_path)
+    def _remove_file(self, relative_file_path: str, status: WitStatus):
+        if not status.is_missing(relative_file_path):
+            self.wit.wit_parent_directory.remove_file(relative_file_path, remove_empty_directories=True)
+        self.wit.staging_area.index.remove(relative_file_path)
 
-    def _copy_tracked_files(self, status: WitStatus):
-        for curr_dir, _, file_names in os.walk(self.image_directory.get_path()):
-            for file_name in file_names:
-                absolute_image_file_path = os.path.join(curr_dir, file_name)
-                relative_file_path = self.image_directory.get_relative_path(absolute_image_file_path)
-                if relative_file_path not in status.untracked_files:
-                    self.image_directory.copy_file_to(self.wit.wit_parent_directory, relative_file_path)
+    def _write_file(self, change: WitChange, status: WitStatus) -> Optional[os.stat_result]:
+        file_stat = None
+        if not status.is_untracked(change.path):
+            working_file_path = self.wit.wit_parent_directory.get_file_path(change.path)
+            self.wit.objects.copy_blob_to(change.new.object_id, working_file_path, change.new.mode)
+            file_stat = os.stat(working_file_path)
+        return file_stat
+
+    def _apply_changes(self, changes: List[WitChange], status: WitStatus):
+        # Removals go first so that a file replaced by a directory, or the other way around, has room
+        for change in changes:
+            if change.old is not None and not change.old.is_directory and MODIFIED != change.kind:
+                self._remove_file(change.path, status)
+        written_changes = [change for change in changes if change.new is not None and not change.new.is_directory]
+        executor = WitExecutor()
+        file_stats = executor.map(lambda change: self._write_file(change, status), written_changes)
+        for change, file_stat in zip(written_changes, file_stats):
+            self.wit.staging_area.index.update(change.path, change.new.object_id, change.new.mode, file_stat)
+        # Tracked files that are missing from the working directory are restored as well
+        written_files = set(change.path for change in written_changes)
+        restored_files = [relative_file_path for relative_file_path in status.missing_files
+                          if relative_file_path not in written_files and self.tree.get_entry(relative_file_path)]
+        executor.run(lambda relative_file_path: self.tree.copy_file_to(self.wit.wit_parent_directory.get_path(),
+                                                                       relative_file_path),
+                     restored_files)
 
     def checkout(self):
         head_commit_id = self.wit.references.get_head()
         head_commit = self.wit.commits[head_commit_id]
-        status = WitStatus(head_commit, self.wit.staging_area)
+        status = WitStatus(head_commit, self.wit.staging_area, self.wit.objects)
 
         if 0 < len(status.changes_to_be_committed):
             print("Changes to be committed:")
@@ -63,10 +86,9 @@ class WitCheckout(object):
                 print(f"{i}) {changes}")
             raise ChangesNotStagedForCommitCheckoutError()
 
-        self._remove_tracked_files(status)
-        self._copy_tracked_files(status)
+        self._apply_changes(self._get_changes(head_commit), status)
+        # The index now holds exactly the files of the checked out commit
+        self.wit.staging_area.index.set_tree_ids({"": self.tree.tree_id})
+        self.wit.staging_area.save_index()
 
         self.wit.references.update_head(self.commit_id)
-
-        self.wit.staging_area.clear_directory()
-        self.wit.staging_area.copy_directory_from(self.commit.commit_dir)
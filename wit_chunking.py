@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import zlib
+from typing import BinaryIO, Iterator
+
+CHUNKING_ENVIRONMENT_VARIABLE = "WIT_CHUNKING_THRESHOLD"
+# Files of at least this size are stored as content-defined chunks, smaller ones as a single object
+DEFAULT_CHUNKING_THRESHOLD = 8 * 1024 * 1024
+MINIMUM_CHUNK_SIZE = 256 * 1024
+AVERAGE_CHUNK_SIZE = 1024 * 1024
+MAXIMUM_CHUNK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 4 * MAXIMUM_CHUNK_SIZE
+
+# A byte by byte rolling hash runs at a few MB/s in Python, so cut points are found in two steps that run in C:
+# every byte is mapped to one bit, a fixed bit pattern picks candidate positions (1 in 4096), and a checksum of the
+# window before a candidate decides whether it ends a chunk (1 in 256 on average)
+BIT_TABLE = bytes(b"01"[hashlib.sha256(bytes([i])).digest()[0] & 1] for i in range(256))
+ANCHOR = b"101100111000"
+WINDOW_SIZE = 64
+# FastCDC normalized chunking: a cut point is harder to hit before the average size and easier after it, which keeps
+# chunk sizes close to the average
+SMALL_CHUNK_MASK = (1 << 10) - 1
+LARGE_CHUNK_MASK = (1 << 6) - 1
+
+
+def get_chunking_threshold() -> int:
+    try:
+        return max(1, int(os.environ[CHUNKING_ENVIRONMENT_VARIABLE]))
+    except (KeyError, ValueError):
+        return DEFAULT_CHUNKING_THRESHOLD
+
+
+def find_cut_point(data: bytearray) -> int:
+    size = len(data)
+    if size <= MINIMUM_CHUNK_SIZE:
+        return size
+    size = min(size, MAXIMUM_CHUNK_SIZE)
+    bits = data[:size].translate(BIT_TABLE)
+    # Positions before the minimum size can never end a chunk, so they are not searched at all
+    position = bits.find(ANCHOR, MINIMUM_CHUNK_SIZE - len(ANCHOR))
+    while -1 != position:
+        end = position + len(ANCHOR)
+        mask = SMALL_CHUNK_MASK if end < AVERAGE_CHUNK_SIZE else LARGE_CHUNK_MASK
+        if not zlib.crc32(data[end - WINDOW_SIZE:end]) & mask:
+            return end
+        position = bits.find(ANCHOR, position + 1)
+    return size
+
+
+def iter_chunks(f: BinaryIO) -> Iterator[bytes]:
+    # Cut points depend only on the bytes before them, so an edit moves the chunk boundaries near it and no others
+    buffer = bytearray()
+    while True:
+        block = f.read(READ_SIZE)
+        buffer += block
+        while len(buffer) >= MAXIMUM_CHUNK_SIZE or (not block and buffer):
+            cut_point = find_cut_point(buffer)
+            yield bytes(buffer[:cut_point])
+            del buffer[:cut_point]
+        if not block:
+            return
@@ -1,59 +1,55 @@
 from __future__ import annotations
 
+import bisect
 import datetime
 import os
-import random
-from typing import Optional, TYPE_CHECKING
+from collections.abc import Mapping
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, TYPE_CHECKING
 
-import dateutil.tz
-
-from wit_classes import ImageDirectory, KeyValueFile
-from wit_exceptions import CommitingSameFilesException
+from wit_classes import KeyValueFile, write_file_atomically
+from wit_exceptions import CommitingSameFilesException, InvalidCommitGraphFormat
+from wit_objects import COMMIT_TYPE, WitObjectStore, WitTree
 if TYPE_CHECKING:
     from wit import WitReferences, WitStagingArea
-
-COMMIT_ID_CHARS = "1234567890abcdef"
-COMMIT_ID_LENGTH = 40
-
-
-class WitCommitImage(ImageDirectory):
-    def __init__(self, image_path: str, commit_id: str):
-        super().__init__(os.path.join(image_path, commit_id))
-        self.commit_id = commit_id
-
-    def commit(self, staging_area: WitStagingArea, parent_commit: Optional[WitCommit]):
-        if parent_commit is not None:
-            if parent_commit.commit_dir.compare_directory(staging_area).is_same():
-                raise CommitingSameFilesException()
-        self._create_commit_dir()
-        self.copy_directory_from(staging_area)
-
-    def _create_commit_dir(self) -> None:
-        if not os.path.exists:
-            os.mkdir(self.get_path())
+    from wit_lock import WitRepositoryLock
 
 
 class WitCommitMetadata(KeyValueFile):
     PARENT_KEY = "parent"
     DATE_KEY = "date"
     MESSAGE_KEY = "message"
-    KEYS = [PARENT_KEY, DATE_KEY, MESSAGE_KEY]
+    TREE_KEY = "tree"
+    KEYS = [PARENT_KEY, DATE_KEY, MESSAGE_KEY, TREE_KEY]
     DATE_FORMAT = "%a %b %d %H:%M:%S %Y %z"
 
-    def __init__(self, image_dir: str, commit_id: str):
+    def __init__(self, image_dir: str, commit_id: Optional[str]):
         super().__init__(os.path.join(image_dir, f"{commit_id}.txt"))
+        self._image_dir = image_dir
+        self.commit_id = commit_id
+
+    def set_commit_id(self, commit_id: str):
         self.commit_id = commit_id
+        self.path = os.path.join(self._image_dir, f"{commit_id}.txt")
 
     def items(self):
-        return [(k, self[k]) for k in self.KEYS]
+        return [(k, self[k]) for k in self.KEYS if k in self]
 
-    def commit(self, message: str, parent_commit: Optional[WitCommit]):
+    def commit(self, message: str, parent_commit: Optional[WitCommit], tree_id: str):
         self[self.PARENT_KEY] = "None"
         if parent_commit:
             self[self.PARENT_KEY] = parent_commit.commit_id
+        import dateutil.tz  # Only commits need it, imported here to keep it out of the startup of other commands
         self[self.DATE_KEY] = self.date_format(datetime.datetime.now(tz=dateutil.tz.tzlocal()))
         self[self.MESSAGE_KEY] = message
-        self.save()
+        self[self.TREE_KEY] = tree_id
+
+    def serialize(self) -> bytes:
+        lines = [f"tree {self[self.TREE_KEY]}\n"]
+        if self.get_parent_id() is not None:
+            lines.append(f"parent {self.get_parent_id()}\n")
+        lines.append(f"date {self[self.DATE_KEY]}\n")
+        lines.append(f"\n{self[self.MESSAGE_KEY]}\n")
+        return "".join(lines).encode()
 
     def date_parse(self, date_str: str) -> datetime.datetime:
         return datetime.datetime.strptime(date_str, self.DATE_FORMAT)
@@ -62,10 +58,10 @@ class WitCommitMetadata(KeyValueFile):
         return date.strftime(self.DATE_FORMAT)
 
     def get_parent_id(self) -> Optional[str]:
-        try:
-            return self[self.PARENT_KEY]
-        except KeyError:
+        parent_id = self.get(self.PARENT_KEY)
+        if not parent_id or "None" == parent_id:  # How a commit without a parent is written
             return None
+        return parent_id
 
     def get_date(self) -> datetime.datetime:
         return self.date_parse(self[self.DATE_KEY])
@@ -73,17 +69,49 @@ class WitCommitMetadata(KeyValueFile):
     def get_message(self) -> str:
         return self[self.MESSAGE_KEY]
 
+    def get_tree_id(self) -> Optional[str]:
+        return self.get(self.TREE_KEY)
+
 
 class WitCommit(object):
-    def __init__(self, image_dir: str, commit_id: str):
+    def __init__(self, image_dir: str, commit_id: Optional[str], objects: WitObjectStore,
+                 graph: Optional[WitCommitGraph] = None):
         self._image_dir = image_dir
+        self._objects = objects
+        self._graph = graph
+        self._tree = None  # type: Optional[WitTree]
         self.commit_id = commit_id
-        self.commit_dir = WitCommitImage(image_dir, commit_id)
         self.commit_file = WitCommitMetadata(image_dir, commit_id)
 
     def commit(self, message: str, parent_commit: Optional[WitCommit], staging_area: WitStagingArea):
-        self.commit_dir.commit(staging_area, parent_commit)
-        self.commit_file.commit(message, parent_commit)
+        tree = staging_area.get_tree(self._objects, write=True)
+        if parent_commit is not None:
+            if parent_commit.get_tree().is_same(tree):
+                raise CommitingSameFilesException()
+        self._tree = tree
+        self.commit_file.commit(message, parent_commit, tree.tree_id)
+        # Like Git, the commit id is the hash of the tree, parent, date and message
+        self.commit_id = self._objects.write_object(COMMIT_TYPE, self.commit_file.serialize())
+        self.commit_file.set_commit_id(self.commit_id)
+
+    def get_tree(self) -> WitTree:
+        if self._tree is None:
+            tree_id = self.commit_file.get_tree_id()
+            if tree_id is not None:
+                self._tree = WitTree(self._objects, tree_id)
+            else:  # Commits made before the object store keep a full image directory
+                legacy_image_path = os.path.join(self._image_dir, self.commit_id)
+                self._tree = WitTree.from_directory(self._objects, legacy_image_path)
+                self._save_tree_id()
+        return self._tree
+
+    def _save_tree_id(self):
+        # The image is hashed the first time it is read only, from then on the commit is read like any other
+        if self._graph is None or not self._graph.is_writable():
+            return
+        self.commit_file[self.commit_file.TREE_KEY] = self._tree.tree_id
+        self.save()
+        self._graph.append(self.commit_id, self.commit_file)  # Later lines of a commit replace earlier ones
 
     def save(self):
         self.commit_file.save()
@@ -91,36 +119,244 @@ class WitCommit(object):
     def load(self):
         self.commit_file.load()
 
-    def get_parent(self) -> Optional['WitCommit']:
-        parent_id = self.commit_file.get_parent_id()
-        if parent_id is not None:
-            return WitCommit(self._image_dir, parent_id)
-        else:
-            return None
 
+class WitCommitGraph(object):
+    FILE_NAME = "commit-graph"
+    SEPARATOR = "\t"
+    ESCAPES = [("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n")]
+    TAIL_READ_SIZE = 64 * 1024
+
+    def __init__(self, wit_images_path: str, lock: WitRepositoryLock):
+        self.path = os.path.join(wit_images_path, self.FILE_NAME)
+        self.lock = lock
+        self.entries = {}  # type: Dict[str, Dict[str, str]]
+
+    def is_writable(self) -> bool:
+        # Commands that only read the repository run without the lock, anything they add is kept in memory only
+        return self.lock.is_locked()
+
+    def _escape(self, value: str) -> str:
+        for raw, escaped in self.ESCAPES:
+            value = value.replace(raw, escaped)
+        return value
+
+    def _unescape(self, value: str) -> str:
+        result = []
+        i = 0
+        while i < len(value):
+            if "\\" == value[i] and i + 1 < len(value):
+                result.append({"t": "\t", "n": "\n"}.get(value[i + 1], value[i + 1]))
+                i += 2
+            else:
+                result.append(value[i])
+                i += 1
+        return "".join(result)
+
+    def _format_line(self, commit_id: str, metadata: Dict[str, str]) -> str:
+        values = [self._escape(metadata.get(key, "")) for key in WitCommitMetadata.KEYS]
+        return self.SEPARATOR.join([commit_id] + values) + "\n"
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf8") as f:
+            for line in f:
+                if not line.endswith("\n"):  # Being appended right now, or an append cut short by a crash
+                    break
+                fields = line.rstrip("\n").split(self.SEPARATOR)
+                if len(fields) != len(WitCommitMetadata.KEYS) + 1:
+                    raise InvalidCommitGraphFormat()
+                commit_id, values = fields[0], fields[1:]
+                metadata = dict(zip(WitCommitMetadata.KEYS, map(self._unescape, values)))
+                if not metadata[WitCommitMetadata.TREE_KEY]:  # Commits made before the object store have no tree
+                    del metadata[WitCommitMetadata.TREE_KEY]
+                self.entries[commit_id] = metadata
 
-class WitCommits(dict):
-    def __init__(self, wit_images_path: str):
-        super().__init__()
+    def _remove_partial_line(self, f: BinaryIO):
+        # Appends are made under the repository lock, so a last line without its newline was left by a crash, and is
+        # cut off for the next line to start on a line of its own
+        end = f.seek(0, os.SEEK_END)
+        if not end:
+            return
+        f.seek(end - 1)
+        if b"\n" == f.read(1):
+            return
+        while end:
+            start = max(0, end - self.TAIL_READ_SIZE)
+            f.seek(start)
+            block = f.read(end - start)
+            if b"\n" in block:
+                f.truncate(start + block.rfind(b"\n") + 1)
+                return
+            end = start
+        f.truncate(0)
+
+    def append(self, commit_id: str, metadata: Dict[str, str]):
+        self.entries[commit_id] = dict(metadata)
+        if not self.is_writable():
+            return
+        with open(self.path, "a+b") as f:
+            self._remove_partial_line(f)
+            f.write(self._format_line(commit_id, metadata).encode("utf8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class WitCommitIdIndex(object):
+    FILE_NAME = "commit-ids"
+    MINIMUM_ABBREVIATION = 7
+
+    def __init__(self, wit_images_path: str, lock: WitRepositoryLock):
+        self.path = os.path.join(wit_images_path, self.FILE_NAME)
+        self.lock = lock
+        self.commit_ids = []  # type: List[str]
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path, "r") as f:
+            self.commit_ids = [line.rstrip("\n") for line in f]
+
+    def save(self):
+        if not self.lock.is_locked():  # Rebuilt again by the next command that holds the lock
+            return
+        write_file_atomically(self.path, "".join(f"{commit_id}\n" for commit_id in self.commit_ids).encode())
+
+    def rebuild(self, commit_ids: Iterable[str]):
+        self.commit_ids = sorted(commit_ids)
+        self.save()
+
+    def add(self, commit_id: str):
+        position = bisect.bisect_left(self.commit_ids, commit_id)
+        if position == len(self.commit_ids) or self.commit_ids[position] != commit_id:
+            self.commit_ids.insert(position, commit_id)
+            self.save()
+
+    def find(self, prefix: str) -> List[str]:
+        matches = []
+        position = bisect.bisect_left(self.commit_ids, prefix)
+        while position < len(self.commit_ids) and self.commit_ids[position].startswith(prefix):
+            matches.append(self.commit_ids[position])
+            position += 1
+        return matches
+
+    def get_shortest_unique_prefix(self, commit_id: str) -> str:
+        length = self.MINIMUM_ABBREVIATION
+        position = bisect.bisect_left(self.commit_ids, commit_id)
+        for neighbour in (position - 1, position + 1):
+            if 0 <= neighbour < len(self.commit_ids):
+                common = os.path.commonprefix([commit_id, self.commit_ids[neighbour]])
+                length = max(length, len(common) + 1)
+        return commit_id[:length]
+
+
+class WitCommits(Mapping):
+    def __init__(self, wit_images_path: str, objects: WitObjectStore, lock: WitRepositoryLock):
         self.path = wit_images_path
-        for commit_id in filter(lambda x: not x.endswith(".txt"), os.listdir(self.path)):
-            commit = WitCommit(self.path, commit_id)
-            commit.load()
-            self[commit_id] = commit
+        self.objects = objects
+        self._commits = {}  # type: Dict[str, WitCommit]
+        self._graph = WitCommitGraph(self.path, lock)
+        self._is_graph_loaded = False
+        self._id_index = WitCommitIdIndex(self.path, lock)
+        self._is_id_index_loaded = False
+        self._parent_ids = {}  # type: Dict[str, Optional[str]]
+
+    def _get_metadata_path(self, commit_id: str) -> str:
+        return os.path.join(self.path, f"{commit_id}.txt")
+
+    def _load_graph(self):
+        if self._is_graph_loaded:
+            return
+        self._graph.load()
+        # Commits written by older versions of wit are added to the graph the first time it is read
+        for file_name in filter(lambda x: x.endswith(".txt"), os.listdir(self.path)):
+            commit_id = file_name[:-len(".txt")]
+            if commit_id not in self._graph.entries:
+                commit = self._load_commit_from_file(commit_id)
+                self._graph.append(commit_id, commit.commit_file)
+        self._is_graph_loaded = True
+
+    def _load_commit_from_file(self, commit_id: str) -> WitCommit:
+        commit = WitCommit(self.path, commit_id, self.objects, self._graph)
+        commit.load()
+        self._commits[commit_id] = commit
+        return commit
+
+    def __getitem__(self, commit_id: str) -> WitCommit:
+        if commit_id in self._commits:
+            return self._commits[commit_id]
+        if commit_id in self._graph.entries:
+            commit = WitCommit(self.path, commit_id, self.objects, self._graph)
+            commit.commit_file.update(self._graph.entries[commit_id])
+            self._commits[commit_id] = commit
+            return commit
+        if commit_id is not None and os.path.exists(self._get_metadata_path(commit_id)):
+            return self._load_commit_from_file(commit_id)
+        raise KeyError(commit_id)
+
+    def __contains__(self, commit_id) -> bool:
+        if commit_id in self._commits or commit_id in self._graph.entries:
+            return True
+        return isinstance(commit_id, str) and os.path.exists(self._get_metadata_path(commit_id))
+
+    def __iter__(self) -> Iterator[str]:
+        self._load_graph()
+        return iter(self._graph.entries)
+
+    def __len__(self) -> int:
+        self._load_graph()
+        return len(self._graph.entries)
+
+    def get_parent_id(self, commit_id: str) -> Optional[str]:
+        if commit_id not in self._parent_ids:
+            self._parent_ids[commit_id] = self[commit_id].commit_file.get_parent_id()
+        return self._parent_ids[commit_id]
+
+    def iter_ancestor_ids(self, commit_id: Optional[str], limit: Optional[int] = None) -> Iterator[str]:
+        # The commit itself first, then its parents one by one. A loop rather than recursion, so that the length of
+        # the history is not bound by the recursion limit, and the whole graph is read once instead of every commit
+        # file on its own
+        self._load_graph()
+        count = 0
+        while commit_id is not None and (limit is None or count < limit):
+            yield commit_id
+            count += 1
+            commit_id = self.get_parent_id(commit_id)
+
+    def iter_ancestors(self, commit_id: Optional[str], limit: Optional[int] = None) -> Iterator[WitCommit]:
+        for ancestor_id in self.iter_ancestor_ids(commit_id, limit):
+            yield self[ancestor_id]
+
+    def _get_id_index(self, rebuild: bool = False) -> WitCommitIdIndex:
+        if rebuild or (not self._is_id_index_loaded and not self._id_index.exists()):
+            self._id_index.rebuild(self)
+        elif not self._is_id_index_loaded:
+            self._id_index.load()
+        self._is_id_index_loaded = True
+        return self._id_index
+
+    def find_by_prefix(self, prefix: str) -> List[str]:
+        matches = self._get_id_index().find(prefix)
+        if 0 == len(matches) and not self._is_graph_loaded:
+            # The index may miss commits written by older versions of wit
+            matches = self._get_id_index(rebuild=True).find(prefix)
+        return matches
 
-    def _generate_commit_id(self) -> str:
-        commit_id = ''.join(random.choices(COMMIT_ID_CHARS, k=COMMIT_ID_LENGTH))
-        while commit_id in self:
-            commit_id = ''.join(random.choices(COMMIT_ID_CHARS, k=COMMIT_ID_LENGTH))
-        return commit_id
+    def get_shortest_unique_prefix(self, commit_id: str) -> str:
+        return self._get_id_index().get_shortest_unique_prefix(commit_id)
 
     def commit(self, message: str, references: WitReferences, staging_area: WitStagingArea):
-        commit_id = self._generate_commit_id()
-        commit = WitCommit(self.path, commit_id)
+        commit = WitCommit(self.path, None, self.objects, self._graph)
         parent_commit = None
         parent_id = references.get_head()
         if parent_id is not None:
             parent_commit = self[parent_id]
         commit.commit(message, parent_commit, staging_area)
-        self[commit_id] = commit
-        references.commit(commit_id)
+        if commit.commit_id not in self:  # Identical commits share an id and are only stored once
+            commit.save()
+            self._commits[commit.commit_id] = commit
+            self._graph.append(commit.commit_id, commit.commit_file)
+            if self._id_index.exists():
+                self._get_id_index().add(commit.commit_id)
+        references.commit(commit.commit_id)
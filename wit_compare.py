@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import os
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, TYPE_CHECKING
+
+from wit_consts import WIT_DIRECTORY_NAME
+from wit_objects import get_file_mode, TREE_MODE, TREE_TYPE, WitFileReference
+
+if TYPE_CHECKING:
+    from wit_ignore import WitIgnore
+    from wit_index import WitIndex
+    from wit_objects import WitObjectStore, WitTree
+
+ADDED = "added"
+MODIFIED = "modified"
+DELETED = "deleted"
+TYPE_CHANGED = "type-changed"
+
+
+class WitEntry(NamedTuple):
+    name: str
+    is_directory: bool
+    mode: Optional[str] = None
+    object_id: Optional[str] = None
+    file_stat: Optional[os.stat_result] = None
+
+
+class WitChange(NamedTuple):
+    kind: str
+    path: str
+    old: Optional[WitEntry] = None
+    new: Optional[WitEntry] = None
+
+
+class WitSource(object):
+    def scan(self, relative_directory: str) -> List[WitEntry]:
+        raise NotImplementedError()
+
+    def get_object_id(self, relative_path: str, entry: WitEntry) -> Optional[str]:
+        return entry.object_id
+
+    def get_directory_id(self, relative_directory: str) -> Optional[str]:
+        return None
+
+    def get_file_path(self, relative_path: str) -> str:
+        raise NotImplementedError()
+
+    def get_file_reference(self, relative_path: str) -> WitFileReference:
+        return WitFileReference(self.get_file_path(relative_path))
+
+
+class WitTreeSource(WitSource):
+    def __init__(self, tree: WitTree):
+        self.tree = tree
+
+    def scan(self, relative_directory: str) -> List[WitEntry]:
+        tree = self.tree.get_directory(relative_directory)
+        if tree is None:
+            return []
+        entries = []
+        for name in sorted(tree.children):
+            mode, object_type, object_id = tree.children[name]
+            entries.append(WitEntry(name, TREE_TYPE == object_type, mode, object_id))
+        return entries
+
+    def get_directory_id(self, relative_directory: str) -> Optional[str]:
+        tree = self.tree.get_directory(relative_directory)
+        return tree.tree_id if tree is not None else None
+
+    def get_file_reference(self, relative_path: str) -> WitFileReference:
+        return self.tree.get_file_reference(relative_path)
+
+
+class WitIndexSource(WitSource):
+    def __init__(self, index: WitIndex, store: WitObjectStore):
+        self.index = index
+        self.store = store
+        self._directories = None  # type: Optional[Dict[str, Dict[str, WitEntry]]]
+
+    def _add_directory(self, directory: str):
+        if directory not in self._directories:
+            self._directories[directory] = {}
+            parent, name = os.path.split(directory)
+            self._add_directory(parent)
+            self._directories[parent][name] = WitEntry(name, True, TREE_MODE, self.index.tree_ids.get(directory))
+
+    def _get_directories(self) -> Dict[str, Dict[str, WitEntry]]:
+        # Built on first use, so that a comparison decided by the root tree id never lists the index
+        if self._directories is None:
+            self._directories = {"": {}}
+            for path, index_entry in self.index.entries.items():
+                directory, name = os.path.split(path)
+                self._add_directory(directory)
+                self._directories[directory][name] = WitEntry(name, False, index_entry.mode, index_entry.object_id)
+        return self._directories
+
+    def scan(self, relative_directory: str) -> List[WitEntry]:
+        entries = self._get_directories().get(relative_directory, {})
+        return [entries[name] for name in sorted(entries)]
+
+    def get_directory_id(self, relative_directory: str) -> Optional[str]:
+        return self.index.tree_ids.get(relative_directory)
+
+    def get_file_reference(self, relative_path: str) -> WitFileReference:
+        return WitFileReference(self.store.path, self.index.entries[relative_path].object_id)
+
+
+class WitWorkingDirectorySource(WitSource):
+    def __init__(self, directory_path: str, index: WitIndex, ignore: Optional[WitIgnore] = None):
+        self.directory_path = directory_path
+        self.index = index
+        self.ignore = ignore
+        # Ignored directories that still hold tracked files, everything untracked below them is ignored as well
+        self._ignored_directories = set()  # type: Set[str]
+
+    def _is_ignored(self, relative_directory: str, relative_path: str, is_directory: bool) -> bool:
+        # Ignore rules only hide untracked files, tracked ones are compared as usual
+        if is_directory:
+            if self.index.is_tracked_directory(relative_path):
+                if relative_directory in self._ignored_directories or self.ignore.is_ignored(relative_path, True):
+                    self._ignored_directories.add(relative_path)
+                return False
+        elif relative_path in self.index.entries:
+            return False
+        return relative_directory in self._ignored_directories or self.ignore.is_ignored(relative_path, is_directory)
+
+    def scan(self, relative_directory: str) -> List[WitEntry]:
+        entries = []
+        try:
+            with os.scandir(os.path.join(self.directory_path, relative_directory)) as it:
+                for dir_entry in it:
+                    is_directory = dir_entry.is_dir()
+                    if is_directory and WIT_DIRECTORY_NAME == dir_entry.name:  # Skip the '.wit' directory itself
+                        continue
+                    if self.ignore is not None and self._is_ignored(
+                            relative_directory, os.path.join(relative_directory, dir_entry.name), is_directory):
+                        continue
+                    if is_directory:
+                        entries.append(WitEntry(dir_entry.name, True))
+                    elif dir_entry.is_file():
+                        file_stat = dir_entry.stat()
+                        entries.append(WitEntry(dir_entry.name, False, get_file_mode(file_stat), None, file_stat))
+        except FileNotFoundError:
+            pass
+        entries.sort(key=lambda entry: entry.name)
+        return entries
+
+    def get_object_id(self, relative_path: str, entry: WitEntry) -> Optional[str]:
+        return self.index.get_object_id(relative_path, self.get_file_path(relative_path), entry.file_stat)
+
+    def get_file_path(self, relative_path: str) -> str:
+        return os.path.join(self.directory_path, relative_path)
+
+
+class WitFsMonitorWorkingDirectorySource(WitWorkingDirectorySource):
+    # Directories without reported changes are listed from the index instead of the disk, and carry its tree ids so
+    # that the comparison skips them whole
+    def __init__(self, directory_path: str, index: WitIndex, ignore: Optional[WitIgnore], dirty_paths: Iterable[str],
+                 store: WitObjectStore):
+        super().__init__(directory_path, index, ignore)
+        self._index_source = WitIndexSource(index, store)
+        self._dirty_paths = set(dirty_paths)
+        self._dirty_directories = set()  # type: Set[str]
+        for path in self._dirty_paths:
+            directory = path
+            while directory:
+                directory = os.path.dirname(directory)
+                if directory in self._dirty_directories:
+                    break
+                self._dirty_directories.add(directory)
+
+    def _is_clean(self, relative_path: str) -> bool:
+        if relative_path in self._dirty_directories:
+            return False
+        # A reported directory may have had anything below it created or removed
+        while relative_path:
+            if relative_path in self._dirty_paths:
+                return False
+            relative_path = os.path.dirname(relative_path)
+        return True
+
+    def scan(self, relative_directory: str) -> List[WitEntry]:
+        if self._is_clean(relative_directory):
+            return self._index_source.scan(relative_directory)
+        entries = super().scan(relative_directory)
+        for i, entry in enumerate(entries):
+            relative_path = os.path.join(relative_directory, entry.name)
+            if entry.is_directory and self._is_clean(relative_path):
+                entries[i] = entry._replace(mode=TREE_MODE, object_id=self.index.tree_ids.get(relative_path))
+        return entries
+
+    def get_object_id(self, relative_path: str, entry: WitEntry) -> Optional[str]:
+        if entry.object_id is not None:
+            return entry.object_id
+        return super().get_object_id(relative_path, entry)
+
+    def get_directory_id(self, relative_directory: str) -> Optional[str]:
+        if self._is_clean(relative_directory):
+            return self.index.tree_ids.get(relative_directory)
+        return None
+
+
+class WitCompare(object):
+    def __init__(self, old: WitSource, new: WitSource):
+        self.old = old
+        self.new = new
+
+    def _one_sided(self, source: WitSource, kind: str, path: str, entry: WitEntry) -> Iterator[WitChange]:
+        if entry.is_directory:
+            for child in source.scan(path):
+                yield from self._one_sided(source, kind, os.path.join(path, child.name), child)
+        elif DELETED == kind:
+            yield WitChange(kind, path, old=entry)
+        else:
+            yield WitChange(kind, path, new=entry)
+
+    def _compare_directory(self, relative_directory: str) -> Iterator[WitChange]:
+        old_entries = self.old.scan(relative_directory)
+        new_entries = self.new.scan(relative_directory)
+        i = j = 0
+        while i < len(old_entries) or j < len(new_entries):
+            if j == len(new_entries) or (i < len(old_entries) and old_entries[i].name < new_entries[j].name):
+                old_entry = old_entries[i]
+                i += 1
+                yield from self._one_sided(self.old, DELETED, os.path.join(relative_directory, old_entry.name),
+                                           old_entry)
+            elif i == len(old_entries) or new_entries[j].name < old_entries[i].name:
+                new_entry = new_entries[j]
+                j += 1
+                yield from self._one_sided(self.new, ADDED, os.path.join(relative_directory, new_entry.name),
+                                           new_entry)
+            else:
+                old_entry, new_entry = old_entries[i], new_entries[j]
+                i += 1
+                j += 1
+                yield from self._compare_entries(os.path.join(relative_directory, old_entry.name), old_entry,
+                                                 new_entry)
+
+    def _compare_entries(self, path: str, old_entry: WitEntry, new_entry: WitEntry) -> Iterator[WitChange]:
+        if old_entry.is_directory and new_entry.is_directory:
+            # Directories with the same tree id hold the same files, so there is nothing to look at below them
+            if old_entry.object_id is None or old_entry.object_id != new_entry.object_id:
+                yield from self._compare_directory(path)
+        elif old_entry.is_directory:
+            yield WitChange(TYPE_CHANGED, path, old_entry, new_entry)
+            yield from self._one_sided(self.old, DELETED, path, old_entry)
+        elif new_entry.is_directory:
+            yield WitChange(TYPE_CHANGED, path, old_entry, new_entry)
+            yield from self._one_sided(self.new, ADDED, path, new_entry)
+        elif self.old.get_object_id(path, old_entry) != self.new.get_object_id(path, new_entry):
+            yield WitChange(MODIFIED, path, old_entry, new_entry)
+
+    def changes(self) -> Iterator[WitChange]:
+        old_root_id = self.old.get_directory_id("")
+        if old_root_id is not None and old_root_id == self.new.get_directory_id(""):
+            return iter(())
+        return self._compare_directory("")
+
+    def is_same(self) -> bool:
+        for _ in self.changes():
+            return False
+        return True
@@ -1,3 +1,21 @@
 WIT_DIRECTORY_NAME = ".wit"
 IMAGES_DIRECTORY_NAME = "images"
 STAGING_DIRECTORY_NAME = "staging_area"
+OBJECTS_DIRECTORY_NAME = "objects"
+INDEX_FILE_NAME = "index"
+WIT_IGNORE_FILE_NAME = ".witignore"
+FSMONITOR_SOCKET_NAME = "fsmonitor.sock"
+PACK_DIRECTORY_NAME = "pack"
+CHUNKED_DIRECTORY_NAME = "chunked"
+# Diff algorithm names are needed to parse every command line, the algorithms themselves only by diff
+MYERS = "myers"
+DIFFLIB = "difflib"
+DIFF_ALGORITHMS = [MYERS, DIFFLIB]
+# Myers wins on lightly changed files and rewrites of unique lines, but on heavily changed files of repeating lines it
+# is several times slower than difflib, see benchmarks/diff_algorithms.py
+DEFAULT_DIFF_ALGORITHM = DIFFLIB
+GRAPH_VIEW_FORMAT = "view"
+GRAPH_DOT_FORMAT = "dot"
+GRAPH_JSON_FORMAT = "json"
+GRAPH_FORMATS = [GRAPH_VIEW_FORMAT, GRAPH_DOT_FORMAT, GRAPH_JSON_FORMAT]
+LOCK_FILE_NAME = "lock"
@@ -1,67 +1,168 @@
 from __future__ import annotations
 
-import difflib
+import collections
+import io
 import os
-from typing import List, Optional, Tuple, TYPE_CHECKING
+import sys
+from typing import Deque, Iterable, Iterator, List, Optional, TextIO, Tuple, TYPE_CHECKING, Union
 
+from wit_classes import discard_output
+from wit_compare import WitChange, WitCompare, WitSource, WitTreeSource
+from wit_consts import DEFAULT_DIFF_ALGORITHM
+from wit_diff_algorithms import unified_diff
 from wit_exceptions import WitDiffCommitArgumentNotSpecificEnoughException, WitDiffNoSuchCommitException
+from wit_objects import WitFileReference
+from wit_parallel import PENDING_TASKS_PER_WORKER
 if TYPE_CHECKING:
+    from concurrent.futures import Future, ProcessPoolExecutor
     from wit import Wit
     from wit_argparse import WitArguments
-    from wit_classes import ImageDirectory
     from wit_commit import WitCommit
 
+# Pairs of files smaller than this together are diffed inline, a worker process costs more than the diff itself
+PARALLEL_DIFF_MINIMUM_SIZE = 64 * 1024
+# As in git, a file with a NUL byte this close to its start is binary and is not diffed line by line
+BINARY_SNIFF_SIZE = 8000
+
+WitFilePair = Tuple[str, Optional[WitFileReference], Optional[WitFileReference]]  # (file_name, old_file, new_file)
+
+
+def get_default_jobs() -> int:
+    return os.cpu_count() or 1
+
+
+def _diff_file_lines(algorithm: str, binary_summary: bool, file_name: str, file1: Optional[WitFileReference],
+                     file2: Optional[WitFileReference]) -> List[str]:
+    return list(Diff(algorithm, binary_summary=binary_summary).diff_file(file_name, file1, file2))
+
 
 class Diff(object):
 
-    def diff_file(self, file_path1: Optional[str], file_path2: Optional[str]):
+    def __init__(self, algorithm: str = DEFAULT_DIFF_ALGORITHM, jobs: int = 1, binary_summary: bool = False):
+        self.algorithm = algorithm
+        self.jobs = jobs
+        self.binary_summary = binary_summary
+
+    @staticmethod
+    def _read_lines(file: WitFileReference) -> List[str]:
+        # Text that is not valid UTF-8 is still diffed, with the bytes that do not decode shown as replacements
+        with io.TextIOWrapper(file.open(), encoding="utf8", errors="replace") as f:
+            return f.readlines()
+
+    @staticmethod
+    def _is_binary(file: Optional[WitFileReference]) -> bool:
+        return file is not None and b"\0" in file.read_head(BINARY_SNIFF_SIZE)
+
+    def _is_binary_pair(self, file_pair: WitFilePair) -> bool:
+        return self._is_binary(file_pair[1]) or self._is_binary(file_pair[2])
+
+    def _diff_binary_file(self, file_name: str, file1: Optional[WitFileReference],
+                          file2: Optional[WitFileReference]) -> Iterator[str]:
+        yield f"Binary files {file_name if file1 is not None else os.devnull} and " \
+              f"{file_name if file2 is not None else os.devnull} differ\n"
+        if self.binary_summary:
+            # Hashing a working directory file reads all of it, so it is only done when asked for
+            for label, file in (("old", file1), ("new", file2)):
+                if file is not None:
+                    yield f"{label}: {file.get_size()} bytes, {file.get_object_id()}\n"
+
+    def diff_file(self, file_name: str, file1: Optional[WitFileReference],
+                  file2: Optional[WitFileReference]) -> Iterator[str]:
+        # Only the first block of each file is read to tell whether it is binary
+        if self._is_binary(file1) or self._is_binary(file2):
+            return self._diff_binary_file(file_name, file1, file2)
         file_name1 = ""
         file_name2 = ""
         file_lines1 = []
         file_lines2 = []
-        if file_path1 is not None:
-            file_name1 = os.path.split(file_path1)[1]
-            with open(file_path1, encoding="utf8") as f:
-                file_lines1 = f.readlines()
-        if file_path2 is not None:
-            file_name2 = os.path.split(file_path2)[1]
-            with open(file_path2, encoding="utf8") as f:
-                file_lines2 = f.readlines()
-        return list(difflib.unified_diff(file_lines1, file_lines2, fromfile=file_name1, tofile=file_name2, n=3))
-
-    def get_list_file_directory(self, directory):
-        for curr_dir, _, file_list in os.walk(directory):
-            fl_list = []
-            for file_name in file_list:
-                file_path = os.path.join(curr_dir, file_name)
-                fl_list.append(file_path)
-            for fl in fl_list:
-                if os.path.isdir(fl):
-                    self.get_list_file_directory(fl)
-            return fl_list
-
-    def diff_file_list(self, dir_path1: str, dir_path2: str, diff_files_list: List[str], funny_files_list: List[str],
-                       left_only_files_list: List[str], right_only_files_list: List[str]):
-        left_only_files_list = list(
-            filter(lambda left_file_name: os.path.isfile(os.path.join(dir_path1, left_file_name)),
-                   left_only_files_list))
-        right_only_files_list = list(
-            filter(lambda right_file_name: os.path.isfile(os.path.join(dir_path2, right_file_name)),
-                   right_only_files_list))
-        files_list = diff_files_list + funny_files_list + left_only_files_list + right_only_files_list
-        files_list.sort()
-        diff_list = []
-        for relative_file_path in files_list:
-            absolute_file_path1 = os.path.join(dir_path1, relative_file_path)
-            absolute_file_path2 = os.path.join(dir_path2, relative_file_path)
-
-            if relative_file_path in diff_files_list or relative_file_path in funny_files_list:
-                diff_list += self.diff_file(absolute_file_path1, absolute_file_path2)
-            elif relative_file_path in left_only_files_list:
-                diff_list += self.diff_file(absolute_file_path1, None)
-            elif relative_file_path in right_only_files_list:
-                diff_list += self.diff_file(None, absolute_file_path2)
-        return diff_list
+        if file1 is not None:
+            file_name1 = file_name
+            file_lines1 = self._read_lines(file1)
+        if file2 is not None:
+            file_name2 = file_name
+            file_lines2 = self._read_lines(file2)
+        return unified_diff(file_lines1, file_lines2, fromfile=file_name1, tofile=file_name2, n=3,
+                            algorithm=self.algorithm)
+
+    @staticmethod
+    def _get_file_pairs(old_source: WitSource, new_source: WitSource,
+                        changes: Iterable[WitChange]) -> Iterator[WitFilePair]:
+        for change in sorted(changes, key=lambda c: c.path):
+            file_name = os.path.split(change.path)[1]
+            old_file = None
+            new_file = None
+            if change.old is not None and not change.old.is_directory:
+                old_file = old_source.get_file_reference(change.path)
+            if change.new is not None and not change.new.is_directory:
+                new_file = new_source.get_file_reference(change.path)
+            if old_file is not None or new_file is not None:
+                yield file_name, old_file, new_file
+
+    @staticmethod
+    def _get_file_pair_size(file_pair: WitFilePair) -> int:
+        return sum(file.get_size() for file in file_pair[1:] if file is not None)
+
+    def diff_files(self, old_source: WitSource, new_source: WitSource,
+                   changes: Iterable[WitChange]) -> Iterator[Iterator[str]]:
+        # A file is read only shortly before its diff is written, so only a few pairs of files are held in memory
+        file_pairs = self._get_file_pairs(old_source, new_source, changes)
+        if self.jobs <= 1:
+            for file_pair in file_pairs:
+                yield self.diff_file(*file_pair)
+            return
+        # Large files are diffed ahead in worker processes while the output keeps the order of the file pairs. A
+        # finished diff is held whole until it is written, so no more than one per worker is asked for ahead, which
+        # keeps memory at jobs times the largest file pair
+        executor = None  # type: Optional[ProcessPoolExecutor]
+        pending = collections.deque()  # type: Deque[Union[Future, WitFilePair]]
+        worker_diff_count = 0
+        try:
+            for file_pair in file_pairs:
+                # Binary files cost a page read whatever their size, no worker is needed for them
+                if self._get_file_pair_size(file_pair) < PARALLEL_DIFF_MINIMUM_SIZE or self._is_binary_pair(file_pair):
+                    pending.append(file_pair)
+                else:
+                    while worker_diff_count >= self.jobs:
+                        pending_diff = pending.popleft()
+                        if not isinstance(pending_diff, tuple):
+                            worker_diff_count -= 1
+                        yield self._get_file_diff(pending_diff)
+                    if executor is None:
+                        # Imported here, as multiprocessing is slow to import and most diffs have no large files
+                        from concurrent.futures import ProcessPoolExecutor
+                        executor = ProcessPoolExecutor(max_workers=self.jobs)
+                    pending.append(executor.submit(_diff_file_lines, self.algorithm, self.binary_summary, *file_pair))
+                    worker_diff_count += 1
+                if len(pending) >= self.jobs * PENDING_TASKS_PER_WORKER:
+                    pending_diff = pending.popleft()
+                    if not isinstance(pending_diff, tuple):
+                        worker_diff_count -= 1
+                    yield self._get_file_diff(pending_diff)
+            while pending:
+                yield self._get_file_diff(pending.popleft())
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    def _get_file_diff(self, pending_diff: Union[Future, WitFilePair]) -> Iterator[str]:
+        if isinstance(pending_diff, tuple):
+            return self.diff_file(*pending_diff)
+        return iter(pending_diff.result())
+
+    def diff_file_list(self, old_source: WitSource, new_source: WitSource,
+                       changes: Iterable[WitChange]) -> Iterator[str]:
+        for file_diff in self.diff_files(old_source, new_source, changes):
+            yield from file_diff
+
+    @staticmethod
+    def write_diff(file_diffs: Iterable[Iterator[str]], output: TextIO):
+        try:
+            for file_diff in file_diffs:
+                output.writelines(file_diff)
+                # Hands every finished file to a pager right away instead of when the output buffer fills up
+                output.flush()
+        except BrokenPipeError:
+            discard_output(output)
 
 
 class WitDiff(Diff):
@@ -70,53 +171,58 @@ class WitDiff(Diff):
         super().__init__()
         self.wit = wit
 
-    def _get_working_directory(self) -> ImageDirectory:
-        return self.wit.wit_parent_directory
+    def _get_working_directory(self) -> WitSource:
+        return self.wit.staging_area.get_working_directory_source()
 
-    def _get_staging_area(self) -> ImageDirectory:
-        return self.wit.staging_area
+    def _get_staging_area(self) -> WitSource:
+        return self.wit.staging_area.get_source()
 
-    def _get_named_commit_image_directory(self, commit_name) -> ImageDirectory:
+    def _get_named_commit_source(self, commit_name) -> WitSource:
         # check if commit_name is a branch name
         if commit_name in self.wit.references:
             branch_commit_id = self.wit.references[commit_name]
             branch_commit = self.wit.commits[branch_commit_id]  # type: WitCommit
-            return branch_commit.commit_dir
+            return WitTreeSource(branch_commit.get_tree())
         # otherwise check if it is a commit id or the beginning of a commit id
         else:
             commit = self._get_commit_by_partial_id(commit_name)
-            return commit.commit_dir
+            return WitTreeSource(commit.get_tree())
 
     def _get_commit_by_partial_id(self, partial_commit_id: str) -> WitCommit:
-        commit_ids = self.wit.commits.keys()
-        fitting_commit_ids = list(filter(lambda commit_id: commit_id.startswith(partial_commit_id), commit_ids))
+        fitting_commit_ids = self.wit.commits.find_by_prefix(partial_commit_id)
         if 0 == len(fitting_commit_ids):
             raise WitDiffNoSuchCommitException(partial_commit_id)
         elif 1 < len(fitting_commit_ids):
-            raise WitDiffCommitArgumentNotSpecificEnoughException(partial_commit_id)
+            raise WitDiffCommitArgumentNotSpecificEnoughException(self._format_candidates(fitting_commit_ids))
         else:
             commit = self.wit.commits[fitting_commit_ids[0]]  # type: WitCommit
             return commit
 
-    def _parse_arguments(self, arguments: WitArguments) -> Tuple[ImageDirectory, ImageDirectory]:
-        old_directory = self._get_named_commit_image_directory("HEAD")
-        new_directory = self._get_working_directory()
+    def _format_candidates(self, commit_ids: List[str]) -> str:
+        return ", ".join(map(self.wit.commits.get_shortest_unique_prefix, commit_ids))
+
+    def _parse_arguments(self, arguments: WitArguments) -> Tuple[WitSource, WitSource]:
+        old_source = self._get_named_commit_source("HEAD")
+        new_source = self._get_working_directory()
         if arguments.is_cached:
-            new_directory = self._get_staging_area()
+            new_source = self._get_staging_area()
 
         if arguments.old_commit is not None:
-            old_directory = self._get_named_commit_image_directory(arguments.old_commit)
+            old_source = self._get_named_commit_source(arguments.old_commit)
         if arguments.new_commit is not None:
-            new_directory = self._get_named_commit_image_directory(arguments.new_commit)
+            new_source = self._get_named_commit_source(arguments.new_commit)
 
-        return old_directory, new_directory
+        return old_source, new_source
 
     def diff(self, arguments: WitArguments):
-        old_directory, new_directory = self._parse_arguments(arguments)
-
-        diff = old_directory.compare_directory(new_directory)
+        self.algorithm = arguments.diff_algorithm
+        self.binary_summary = arguments.binary_summary
+        self.jobs = arguments.jobs if arguments.jobs is not None else get_default_jobs()
+        old_source, new_source = self._parse_arguments(arguments)
 
-        diff_lines = self.diff_file_list(old_directory.get_path(), new_directory.get_path(), diff.diff_files,
-                                         diff.funny_files, diff.left_only, diff.right_only)
+        diff = WitCompare(old_source, new_source)
 
-        print("".join(diff_lines))
+        try:
+            self.write_diff(self.diff_files(old_source, new_source, diff.changes()), sys.stdout)
+        finally:
+            self.wit.staging_area.save_index()
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import difflib
+import math
+from typing import Dict, Hashable, Iterator, List, Optional, Sequence, Tuple
+
+from wit_consts import DEFAULT_DIFF_ALGORITHM, DIFFLIB
+# Past this many edits a range is split at the furthest point reached instead of at the true middle snake, as xdiff
+# does, which keeps very different files from taking O((N+M)D) time at the price of a slightly longer diff
+MINIMUM_MAXIMUM_COST = 256
+
+WitMatch = Tuple[int, int, int]  # (old_start, new_start, length)
+WitSnake = Tuple[int, int, int, int]  # (old_start, new_start, old_end, new_end)
+
+
+def hash_lines(lines1: Sequence[Hashable], lines2: Sequence[Hashable]) -> Tuple[List[int], List[int]]:
+    # Equal lines get equal numbers, so the inner loops compare small ints instead of strings
+    line_numbers = {}  # type: Dict[Hashable, int]
+    hashed_lines1 = [line_numbers.setdefault(line, len(line_numbers)) for line in lines1]
+    hashed_lines2 = [line_numbers.setdefault(line, len(line_numbers)) for line in lines2]
+    return hashed_lines1, hashed_lines2
+
+
+def _find_middle_snake(a: List[int], a_low: int, a_high: int, b: List[int], b_low: int, b_high: int,
+                       maximum_cost: int) -> WitSnake:
+    n = a_high - a_low
+    m = b_high - b_low
+    delta = n - m
+    is_odd = 1 == delta & 1
+    # The search never goes past maximum_cost edits, so the arrays need not be sized for the whole range. Sizing them
+    # for n + m made every split of a large range cost O(n + m) however short its search was
+    max_d = min((n + m + 1) // 2, maximum_cost)
+    offset = max_d + 1
+    # forward[k] / backward[k] hold the furthest x reached on diagonal k from the start / from the end
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_low + x] == b[b_low + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if is_odd and -(d - 1) <= delta - k <= d - 1 and x + backward[offset + delta - k] >= n:
+                return a_low + start_x, b_low + start_y, a_low + x, b_low + y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_high - 1 - x] == b[b_high - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not is_odd and -d <= delta - k <= d and x + forward[offset + delta - k] >= n:
+                return a_high - x, b_high - y, a_high - start_x, b_high - start_y
+        if d >= maximum_cost:
+            return _find_furthest_point(forward, backward, offset, d, a_low, n, b_low, m)
+    raise AssertionError("Myers middle snake not found")
+
+
+def _find_furthest_point(forward: List[int], backward: List[int], offset: int, d: int,
+                         a_low: int, n: int, b_low: int, m: int) -> WitSnake:
+    best_progress = -1
+    best_point = (0, 0)
+    for k in range(-d, d + 1, 2):
+        for furthest, is_forward in ((forward, True), (backward, False)):
+            x = furthest[offset + k]
+            y = x - k
+            if 0 <= y and x <= n and y <= m and x + y < n + m and x + y > best_progress:
+                best_progress = x + y
+                best_point = (x, y) if is_forward else (n - x, m - y)
+    x, y = best_point
+    return a_low + x, b_low + y, a_low + x, b_low + y
+
+
+def _discard_unmatched_lines(a: List[int], b: List[int]) -> Tuple[List[int], List[int], List[int], List[int]]:
+    # A line found on one side only can never be part of a match. Like xdiff, such lines are left out of the search,
+    # which on a heavily changed file is most of them, and the positions of the kept lines are returned with them
+    lines_a = set(a)
+    lines_b = set(b)
+    positions_a = [i for i, line in enumerate(a) if line in lines_b]
+    positions_b = [i for i, line in enumerate(b) if line in lines_a]
+    return [a[i] for i in positions_a], [b[i] for i in positions_b], positions_a, positions_b
+
+
+def myers_matching_blocks(a: List[int], b: List[int], maximum_cost: Optional[int] = None) -> List[WitMatch]:
+    kept_a, kept_b, positions_a, positions_b = _discard_unmatched_lines(a, b)
+    if maximum_cost is None:
+        maximum_cost = max(MINIMUM_MAXIMUM_COST, math.isqrt(len(kept_a) + len(kept_b)))
+    matches = []  # type: List[WitMatch]
+    # A match between kept lines is split wherever discarded lines fall between two of its lines on either side
+    for kept_start_a, kept_start_b, length in _myers_matching_blocks(kept_a, kept_b, maximum_cost):
+        start = 0
+        for i in range(1, length + 1):
+            if length == i or positions_a[kept_start_a + i] != positions_a[kept_start_a + i - 1] + 1 \
+                    or positions_b[kept_start_b + i] != positions_b[kept_start_b + i - 1] + 1:
+                matches.append((positions_a[kept_start_a + start], positions_b[kept_start_b + start], i - start))
+                start = i
+    return matches
+
+
+def _myers_matching_blocks(a: List[int], b: List[int], maximum_cost: int) -> List[WitMatch]:
+    matches = []  # type: List[WitMatch]
+    # Ranges are split around their middle snake, which keeps memory linear in the input size
+    pending = [(0, len(a), 0, len(b))]  # type: List[Tuple[int, ...]]
+    while pending:
+        item = pending.pop()
+        if 3 == len(item):
+            matches.append(item)
+            continue
+        a_low, a_high, b_low, b_high = item
+        prefix_length = 0
+        while a_low + prefix_length < a_high and b_low + prefix_length < b_high \
+                and a[a_low + prefix_length] == b[b_low + prefix_length]:
+            prefix_length += 1
+        if prefix_length:
+            matches.append((a_low, b_low, prefix_length))
+            a_low += prefix_length
+            b_low += prefix_length
+        suffix_length = 0
+        while a_low < a_high - suffix_length and b_low < b_high - suffix_length \
+                and a[a_high - 1 - suffix_length] == b[b_high - 1 - suffix_length]:
+            suffix_length += 1
+        if suffix_length:
+            a_high -= suffix_length
+            b_high -= suffix_length
+            # Pushed first so it comes out after everything that is between the prefix and the suffix
+            pending.append((a_high, b_high, suffix_length))
+        if a_low == a_high or b_low == b_high:
+            continue
+        snake_start_a, snake_start_b, snake_end_a, snake_end_b = _find_middle_snake(a, a_low, a_high,
+                                                                                    b, b_low, b_high, maximum_cost)
+        pending.append((snake_end_a, a_high, snake_end_b, b_high))
+        if snake_start_a < snake_end_a:
+            pending.append((snake_start_a, snake_start_b, snake_end_a - snake_start_a))
+        pending.append((a_low, snake_start_a, b_low, snake_start_b))
+
+    merged_matches = []  # type: List[WitMatch]
+    for match in matches:
+        if merged_matches and merged_matches[-1][0] + merged_matches[-1][2] == match[0] \
+                and merged_matches[-1][1] + merged_matches[-1][2] == match[1]:
+            last = merged_matches.pop()
+            match = (last[0], last[1], last[2] + match[2])
+        merged_matches.append(match)
+    return merged_matches
+
+
+class WitMyersMatcher(difflib.SequenceMatcher):
+    # Only replaces how matching blocks are found, opcodes and hunk grouping come from difflib as they are
+    def __init__(self, a: Sequence[str], b: Sequence[str]):
+        super().__init__(None, (), ())
+        self.a = a
+        self.b = b
+
+    def get_matching_blocks(self) -> List[difflib.Match]:
+        if self.matching_blocks is None:
+            hashed_a, hashed_b = hash_lines(self.a, self.b)
+            self.matching_blocks = [difflib.Match(*match) for match in myers_matching_blocks(hashed_a, hashed_b)]
+            self.matching_blocks.append(difflib.Match(len(self.a), len(self.b), 0))
+        return self.matching_blocks
+
+
+def _format_range(start: int, stop: int) -> str:
+    beginning = start + 1
+    length = stop - start
+    if 1 == length:
+        return f"{beginning}"
+    if 0 == length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def unified_diff(a: Sequence[str], b: Sequence[str], fromfile: str = "", tofile: str = "", n: int = 3,
+                 algorithm: str = DEFAULT_DIFF_ALGORITHM) -> Iterator[str]:
+    if DIFFLIB == algorithm:
+        yield from difflib.unified_diff(a, b, fromfile=fromfile, tofile=tofile, n=n)
+        return
+    is_first_group = True
+    for group in WitMyersMatcher(a, b).get_grouped_opcodes(n):
+        if is_first_group:
+            is_first_group = False
+            yield f"--- {fromfile}\n"
+            yield f"+++ {tofile}\n"
+        first, last = group[0], group[-1]
+        yield f"@@ -{_format_range(first[1], last[2])} +{_format_range(first[3], last[4])} @@\n"
+        for tag, i1, i2, j1, j2 in group:
+            if "equal" == tag:
+                for line in a[i1:i2]:
+                    yield " " + line
+                continue
+            if tag in ("replace", "delete"):
+                for line in a[i1:i2]:
+                    yield "-" + line
+            if tag in ("replace", "insert"):
+                for line in b[j1:j2]:
+                    yield "+" + line
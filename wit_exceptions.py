@@ -23,22 +23,38 @@ class InvalidKeyValueFileDuplicateKeys(KeyError):
     pass
 
 
+class WitRepositoryLocked(OSError):
+    pass
+
+
 # init related exceptions
 # add related exceptions
 class NonExistingAddTarget(ValueError):
     pass
 
 
+class IgnoredAddTarget(ValueError):
+    pass
+
+
 # commit related exceptions
 class CommitingSameFilesException(ValueError):
     pass
 
 
+class InvalidCommitGraphFormat(ValueError):
+    pass
+
+
 # checkout related code
 class InvalidCheckoutArgument(KeyError):
     pass
 
 
+class AmbiguousCheckoutArgument(InvalidCheckoutArgument):
+    pass
+
+
 class ChangesToBeCommitCheckoutError(ValueError):
     pass
 
@@ -47,6 +63,15 @@ class ChangesNotStagedForCommitCheckoutError(ValueError):
     pass
 
 
+# graph related code
+class InvalidGraphArgument(KeyError):
+    pass
+
+
+class AmbiguousGraphArgument(InvalidGraphArgument):
+    pass
+
+
 # diff related code
 class WitDiffNoSuchCommitException(KeyError):
     pass
@@ -54,3 +79,34 @@ class WitDiffNoSuchCommitException(KeyError):
 
 class WitDiffCommitArgumentNotSpecificEnoughException(IndexError):
     pass
+
+
+# object store related exceptions
+class WitObjectNotFoundException(KeyError):
+    pass
+
+
+class InvalidWitObjectFormat(ValueError):
+    pass
+
+
+class InvalidWitPackFormat(ValueError):
+    pass
+
+
+# index related exceptions
+class InvalidWitIndexFormat(ValueError):
+    pass
+
+
+# fsmonitor related exceptions
+class WitFsMonitorNotSupported(OSError):
+    pass
+
+
+class WitFsMonitorAlreadyRunning(OSError):
+    pass
+
+
+class WitFsMonitorStartFailed(OSError):
+    pass
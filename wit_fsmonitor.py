@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import errno
+import os
+import struct
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, TYPE_CHECKING
+
+from wit_consts import FSMONITOR_SOCKET_NAME, WIT_DIRECTORY_NAME, WIT_IGNORE_FILE_NAME
+from wit_exceptions import WitFsMonitorAlreadyRunning, WitFsMonitorNotSupported, WitFsMonitorStartFailed
+
+# Every status queries the daemon through this module, so what only the daemon or a connection needs (ctypes,
+# selectors, socket, subprocess, json) is imported where it is used
+if TYPE_CHECKING:
+    import socket
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT_HEADER = struct.Struct("iIII")  # struct inotify_event without its name
+READ_SIZE = 64 * 1024
+
+QUERY_COMMAND = "query"
+STOP_COMMAND = "stop"
+CLIENT_TIMEOUT = 1.0
+# Past this many remembered paths the daemon forgets them and answers the next queries with a full scan
+MAXIMUM_CHANGED_PATHS = 1000000
+
+
+class WitFsMonitorResponse(NamedTuple):
+    token: str
+    is_full_scan: bool
+    paths: List[str]
+
+
+class WitInotify(object):
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise WitFsMonitorNotSupported(sys.platform)
+        import ctypes
+        import ctypes.util
+        self._get_errno = ctypes.get_errno
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self._get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(self._get_errno(), "inotify_add_watch failed", path)
+        return wd
+
+    def remove_watch(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> List[Tuple[int, int, str]]:
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+                offset += name_length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WitFsMonitorDaemon(object):
+    def __init__(self, root_path: str):
+        self.root_path = root_path
+        self.socket_path = os.path.join(root_path, WIT_DIRECTORY_NAME, FSMONITOR_SOCKET_NAME)
+        # Tokens are '<instance>:<sequence>', a token of another daemon run cannot say what happened since
+        self.instance = f"{os.getpid()}-{time.time_ns()}"
+        self.sequence = 0
+        self.overflow_sequence = 0
+        self.changed_paths = {}  # type: Dict[str, int]  # Path to the sequence number of its last change
+        self._watches = {}  # type: Dict[int, str]  # Watch descriptor to the relative directory it watches
+        self._inotify = None  # type: Optional[WitInotify]
+        # Directories left unwatched once the inotify watch limit is reached make every answer a full scan
+        self._is_watching_everything = True
+        self._is_running = False
+
+    def _mark_changed(self, relative_path: str):
+        self.changed_paths[relative_path] = self.sequence
+        if len(self.changed_paths) > MAXIMUM_CHANGED_PATHS:
+            self._overflow()
+
+    def _overflow(self):
+        self.changed_paths.clear()
+        self.overflow_sequence = self.sequence
+
+    def _watch_directory(self, relative_directory: str, mark_changed: bool):
+        for curr_dir, dir_names, file_names in os.walk(os.path.join(self.root_path, relative_directory)):
+            relative_curr_dir = os.path.relpath(curr_dir, self.root_path)
+            if os.curdir == relative_curr_dir:
+                relative_curr_dir = ""
+                if WIT_DIRECTORY_NAME in dir_names:  # Skip the '.wit' directory itself
+                    dir_names.remove(WIT_DIRECTORY_NAME)
+            try:
+                self._watches[self._inotify.add_watch(curr_dir)] = relative_curr_dir
+            except OSError as e:
+                # Out of watches this directory goes unseen, any other error means it is already gone
+                if errno.ENOSPC == e.errno:
+                    self._is_watching_everything = False
+                continue
+            if mark_changed:
+                # Files created before the watch existed did not produce events of their own
+                for name in dir_names + file_names:
+                    self._mark_changed(os.path.join(relative_curr_dir, name))
+
+    def _unwatch_directory(self, relative_directory: str):
+        prefix = relative_directory + os.sep
+        for wd, watched_directory in list(self._watches.items()):
+            if watched_directory == relative_directory or watched_directory.startswith(prefix):
+                self._inotify.remove_watch(wd)
+                del self._watches[wd]
+
+    def _handle_events(self):
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self._overflow()
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None or (not directory and WIT_DIRECTORY_NAME == name):
+                continue
+            relative_path = os.path.join(directory, name) if name else directory
+            self._mark_changed(relative_path)
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self._unwatch_directory(relative_path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_directory(relative_path, mark_changed=True)
+
+    def query(self, token: Optional[str]) -> WitFsMonitorResponse:
+        # Events that are already queued belong to the answer, only later ones are left for the next token
+        self._handle_events()
+        is_full_scan = True
+        paths = []
+        if token is not None and self._is_watching_everything:
+            instance, _, sequence = token.rpartition(":")
+            if instance == self.instance and sequence.isdigit() and int(sequence) >= self.overflow_sequence:
+                is_full_scan = False
+                paths = [path for path, changed in self.changed_paths.items() if changed > int(sequence)]
+        response = WitFsMonitorResponse(f"{self.instance}:{self.sequence}", is_full_scan, paths)
+        self.sequence += 1
+        return response
+
+    def _handle_client(self, connection: socket.socket):
+        import json
+        with connection:
+            try:
+                connection.settimeout(CLIENT_TIMEOUT)
+                request = connection.makefile("r", encoding="utf8").readline().split()
+                if not request:
+                    return
+                if STOP_COMMAND == request[0]:
+                    self._is_running = False
+                    response = {}
+                else:
+                    response = self.query(request[1] if 1 < len(request) else None)._asdict()
+                connection.sendall(json.dumps(response).encode() + b"\n")
+            except OSError:  # A client that went away does not stop the daemon
+                pass
+
+    def _bind(self) -> socket.socket:
+        if os.path.exists(self.socket_path):
+            if WitFsMonitorClient(self.root_path).is_running():
+                raise WitFsMonitorAlreadyRunning(self.socket_path)
+            os.remove(self.socket_path)
+        import socket
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen()
+        return server
+
+    def run(self):
+        import selectors
+        self._inotify = WitInotify()
+        try:
+            self._watch_directory("", mark_changed=False)
+            server = self._bind()
+            try:
+                with selectors.DefaultSelector() as selector:
+                    selector.register(self._inotify.fd, selectors.EVENT_READ)
+                    selector.register(server, selectors.EVENT_READ)
+                    self._is_running = True
+                    while self._is_running:
+                        for key, _ in selector.select():
+                            if key.fileobj is server:
+                                self._handle_client(server.accept()[0])
+                            else:
+                                self._handle_events()
+            finally:
+                server.close()
+                os.remove(self.socket_path)
+        finally:
+            self._inotify.close()
+
+
+class WitFsMonitorClient(object):
+    def __init__(self, root_path: str):
+        self.root_path = root_path
+        self.socket_path = os.path.join(root_path, WIT_DIRECTORY_NAME, FSMONITOR_SOCKET_NAME)
+
+    def _request(self, request: str) -> Optional[dict]:
+        if not os.path.exists(self.socket_path):
+            return None
+        import json
+        import socket
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(CLIENT_TIMEOUT)
+                connection.connect(self.socket_path)
+                connection.sendall(f"{request}\n".encode())
+                return json.loads(connection.makefile("r", encoding="utf8").readline())
+        except (OSError, ValueError):
+            return None
+
+    def is_running(self) -> bool:
+        return self._request(QUERY_COMMAND) is not None
+
+    def query(self, token: Optional[str]) -> Optional[WitFsMonitorResponse]:
+        # None means there is no daemon to ask, the caller scans the whole working directory without a token
+        response = self._request(QUERY_COMMAND if token is None else f"{QUERY_COMMAND} {token}")
+        if response is None:
+            return None
+        try:
+            return WitFsMonitorResponse(response["token"], response["is_full_scan"], response["paths"])
+        except (KeyError, TypeError):
+            return None
+
+    def stop(self):
+        self._request(STOP_COMMAND)
+
+    def start(self):
+        if self.is_running():
+            raise WitFsMonitorAlreadyRunning(self.socket_path)
+        import subprocess
+        process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "wit.py"),
+                                    "fsmonitor", "run"], cwd=self.root_path, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+        # The daemon answers only once every directory is watched
+        while not self.is_running():
+            if process.poll() is not None:
+                raise WitFsMonitorStartFailed(process.stderr.read().decode(errors="replace"))
+            time.sleep(0.05)
+        process.stderr.close()
+
+
+def get_dirty_paths(response: WitFsMonitorResponse, previous_paths: Set[str]) -> Optional[Set[str]]:
+    # A changed ignore file changes which untracked files are shown anywhere below it, so it needs a full scan
+    if response.is_full_scan or any(WIT_IGNORE_FILE_NAME == os.path.basename(path) for path in response.paths):
+        return None
+    return previous_paths.union(response.paths)
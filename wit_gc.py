@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import os
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from wit_objects import TREE_TYPE
+from wit_pack import INDEX_SUFFIX, MAXIMUM_DELTA_DEPTH, PACK_SUFFIX, WitPackWriter
+
+if TYPE_CHECKING:
+    from wit import Wit
+    from wit_objects import WitTree
+
+
+class WitGc(object):
+    def __init__(self, wit: Wit):
+        self.wit = wit
+        self.store = wit.objects
+
+    def _add_tree_history(self, tree: WitTree, relative_directory: str, histories: Dict[str, List[str]],
+                          visited: Set[Tuple[str, str]]):
+        # A directory with the same tree id in an older commit adds no new versions of its files
+        if (relative_directory, tree.tree_id) in visited:
+            return
+        visited.add((relative_directory, tree.tree_id))
+        for name in sorted(tree.children):
+            _, object_type, object_id = tree.children[name]
+            path = os.path.join(relative_directory, name)
+            if TREE_TYPE == object_type:
+                self._add_tree_history(tree.get_subtree(name), path, histories, visited)
+            else:
+                history = histories.setdefault(path, [])
+                if object_id not in history:
+                    history.append(object_id)
+
+    def _get_path_histories(self) -> Dict[str, List[str]]:
+        # Every version of a path, newest first. The newest one is stored whole and every older one as a delta
+        # against the version that came after it, as it is the one most often read
+        histories = {}  # type: Dict[str, List[str]]
+        for relative_path, index_entry in sorted(self.wit.staging_area.index.entries.items()):
+            histories[relative_path] = [index_entry.object_id]
+        commits = sorted((self.wit.commits[commit_id] for commit_id in self.wit.commits),
+                         key=lambda commit: commit.commit_file.get_date(), reverse=True)
+        visited = set()  # type: Set[Tuple[str, str]]
+        for commit in commits:
+            self._add_tree_history(commit.get_tree(), "", histories, visited)
+        return histories
+
+    def gc(self):
+        loose_object_ids = set(self.store.iter_loose_objects())
+        object_ids = loose_object_ids.union(self.store.packs)
+        if not object_ids:
+            return
+        histories = self._get_path_histories()
+        old_pack_paths = self.store.packs.get_pack_paths()
+        delta_depths = {}  # type: Dict[str, int]
+        writer = WitPackWriter(self.store.packs.path, len(object_ids))
+        try:
+            for history in histories.values():
+                previous_id = None  # type: Optional[str]
+                previous_data = None  # type: Optional[bytes]
+                for object_id in history:
+                    if object_id not in object_ids:
+                        continue
+                    data = self.store.read_object(object_id)
+                    if object_id not in delta_depths:
+                        if previous_id is not None and delta_depths[previous_id] < MAXIMUM_DELTA_DEPTH:
+                            is_delta = writer.add(object_id, data, previous_id, previous_data)
+                        else:
+                            is_delta = writer.add(object_id, data)
+                        delta_depths[object_id] = delta_depths[previous_id] + 1 if is_delta else 0
+                    previous_id, previous_data = object_id, data
+            for object_id in sorted(object_ids.difference(delta_depths)):
+                writer.add(object_id, self.store.read_object(object_id))
+            pack_path = writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+        # Objects are removed only once the new pack is on disk and can be read, readers fall back to it from then on
+        self.store.packs.reload()
+        new_pack_paths = {pack_path, pack_path[:-len(PACK_SUFFIX)] + INDEX_SUFFIX}
+        for path in old_pack_paths:
+            if path not in new_pack_paths:  # Repacking the same objects gives a pack of the same name
+                os.remove(path)
+        for object_id in loose_object_ids:
+            self.store.remove_loose_object(object_id)
+        print(f"Packed {len(object_ids)} objects, {sum(1 for depth in delta_depths.values() if depth)} as deltas")
@@ -1,13 +1,21 @@
 from __future__ import annotations
 
-from typing import Optional, TYPE_CHECKING
+import json
+import sys
+from typing import Dict, List, Optional, Set, TextIO, TYPE_CHECKING
 
-from graphviz import Digraph
+from wit_classes import discard_output
+from wit_consts import GRAPH_DOT_FORMAT, GRAPH_JSON_FORMAT
+from wit_exceptions import AmbiguousGraphArgument, InvalidGraphArgument
 
 if TYPE_CHECKING:
+    from graphviz import Digraph
     from wit import Wit
+    from wit_argparse import WitArguments
     from wit_commit import WitCommit
 
+RANGE_SEPARATOR = ".."
+
 
 class WitGraph(object):
     GRAPH_FILE_NAME = "graph.gv"
@@ -32,23 +40,74 @@ class WitGraph(object):
         grpc.edge(f'{commit_id}', f'{parent_id}', label=label, constraint='false', color="blue")
 
     def _add_tag(self, grpc: Digraph, commit: WitCommit, label: str):
-        grpc.edge('', f'{commit.commit_id}', label=f'{label}::sw')
+        # Every reference gets a node of its own, rather than all of them sharing one unnamed node
+        grpc.node(f'ref-{label}', label, shape="box")
+        grpc.edge(f'ref-{label}', f'{commit.commit_id}')
 
-    def _add_parent(self, grpc: Digraph, commit: WitCommit):
-        parent = commit.get_parent()
-        if parent is not None:
-            self._add_node(grpc, parent)
-            self._add_edge(grpc, commit, parent)
-            self._add_parent(grpc, parent)
+    def _resolve_commit_id(self, name: str) -> str:
+        if name in self.wit.references:
+            return self.wit.references[name]
+        commit_ids = self.wit.commits.find_by_prefix(name)
+        if 0 == len(commit_ids):
+            raise InvalidGraphArgument(name)
+        if 1 < len(commit_ids):
+            raise AmbiguousGraphArgument(", ".join(map(self.wit.commits.get_shortest_unique_prefix, commit_ids)))
+        return commit_ids[0]
+
+    def _get_commit_ids(self, revision_range: Optional[str], limit: Optional[int]) -> List[str]:
+        # 'old..new' shows the commits that new has and old does not, a single name the history leading to it
+        excluded_ids = set()  # type: Set[str]
+        if revision_range is None:
+            commit_id = self.wit.references.get_head()
+        elif RANGE_SEPARATOR in revision_range:
+            old_name, _, new_name = revision_range.partition(RANGE_SEPARATOR)
+            excluded_ids.update(self.wit.commits.iter_ancestor_ids(self._resolve_commit_id(old_name or "HEAD")))
+            commit_id = self._resolve_commit_id(new_name or "HEAD")
+        else:
+            commit_id = self._resolve_commit_id(revision_range)
+        commit_ids = []
+        for ancestor_id in self.wit.commits.iter_ancestor_ids(commit_id, limit):
+            if ancestor_id in excluded_ids:
+                break
+            commit_ids.append(ancestor_id)
+        return commit_ids
 
-    def show(self):
+    def _get_references(self, commit_ids: List[str]) -> Dict[str, str]:
+        shown_ids = set(commit_ids)
+        return {name: commit_id for name, commit_id in self.wit.references.items() if commit_id in shown_ids}
+
+    def _build_digraph(self, commit_ids: List[str]) -> Digraph:
+        from graphviz import Digraph  # Only needed to draw the graph, not to export it as JSON
         grpc = Digraph(comment='graph')
-        head_id = self.wit.references.get_head()
-        head_commit = self.wit.commits[head_id]
-        self._add_node(grpc, head_commit)
-        self._add_parent(grpc, head_commit)
-        for tag_name, commit_id in self.wit.references.items():
-            commit = self.wit.commits[commit_id]
-            self._add_tag(grpc, commit, tag_name)
-
-        grpc.view(self.GRAPH_FILE_NAME, self.wit_directory, cleanup=True)
+        commit = None  # type: Optional[WitCommit]
+        for parent in map(self.wit.commits.__getitem__, commit_ids):
+            self._add_node(grpc, parent)
+            if commit is not None:
+                self._add_edge(grpc, commit, parent)
+            commit = parent
+        for tag_name, commit_id in self._get_references(commit_ids).items():
+            self._add_tag(grpc, self.wit.commits[commit_id], tag_name)
+        return grpc
+
+    def write_json(self, commit_ids: List[str], output: TextIO):
+        # Written one commit at a time, a long history is never held as one JSON document in memory
+        output.write(f'{{"references": {json.dumps(self._get_references(commit_ids))}, "commits": [')
+        for i, commit_id in enumerate(commit_ids):
+            commit_file = self.wit.commits[commit_id].commit_file
+            record = {"id": commit_id, "parent": commit_file.get_parent_id(),
+                      "date": commit_file[commit_file.DATE_KEY], "message": commit_file.get_message()}
+            output.write(f'{", " if i else ""}{json.dumps(record)}')
+        output.write("]}\n")
+
+    def show(self, arguments: WitArguments):
+        commit_ids = self._get_commit_ids(arguments.revision_range, arguments.max_count)
+        try:
+            if GRAPH_JSON_FORMAT == arguments.graph_format:
+                self.write_json(commit_ids, sys.stdout)
+            elif GRAPH_DOT_FORMAT == arguments.graph_format:
+                sys.stdout.write(self._build_digraph(commit_ids).source)
+            else:
+                self._build_digraph(commit_ids).view(self.GRAPH_FILE_NAME, self.wit_directory, cleanup=True)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            discard_output(sys.stdout)
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import os
+import re
+from typing import Dict, List, Optional, Pattern, Tuple
+
+from wit_consts import WIT_IGNORE_FILE_NAME
+
+
+class WitIgnoreRules(object):
+    def __init__(self, lines: List[str]):
+        # Consecutive patterns of the same kind are joined into one regular expression. Groups are tried from the last
+        # one and the first that matches decides, which gives the last matching pattern precedence like in git
+        self.groups = []  # type: List[Tuple[Pattern, bool, bool]]  # (regex, is_negated, is_directory_only)
+        patterns = []  # type: List[str]
+        group_kind = None  # type: Optional[Tuple[bool, bool]]
+        for line in lines:
+            rule = self._parse_line(line)
+            if rule is None:
+                continue
+            pattern, is_negated, is_directory_only = rule
+            if group_kind is not None and group_kind != (is_negated, is_directory_only):
+                self.groups.append((re.compile("|".join(patterns)), *group_kind))
+                patterns = []
+            group_kind = (is_negated, is_directory_only)
+            patterns.append(f"(?:{pattern})")
+        if patterns:
+            self.groups.append((re.compile("|".join(patterns)), *group_kind))
+        self.groups.reverse()
+
+    @classmethod
+    def _parse_line(cls, line: str) -> Optional[Tuple[str, bool, bool]]:
+        line = line.rstrip("\n").rstrip()
+        if not line or line.startswith("#"):
+            return None
+        is_negated = line.startswith("!")
+        if is_negated:
+            line = line[1:]
+        elif line.startswith("\\"):  # '\#' and '\!' match names starting with '#' and '!'
+            line = line[1:]
+        is_directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return None
+        # A pattern with a slash before its end is relative to the directory of the ignore file, otherwise it
+        # matches a name at any depth below it
+        is_anchored = "/" in line
+        pattern = cls._translate(line.lstrip("/"))
+        if not is_anchored:
+            pattern = f"(?:.*/)?{pattern}"
+        return pattern, is_negated, is_directory_only
+
+    @staticmethod
+    def _translate(glob: str) -> str:
+        regex = []
+        i = 0
+        while i < len(glob):
+            c = glob[i]
+            if glob.startswith("**/", i) and (0 == i or "/" == glob[i - 1]):
+                regex.append("(?:.*/)?")
+                i += 3
+                continue
+            if glob.startswith("**", i) and i + 2 == len(glob) and 0 < i and "/" == glob[i - 1]:
+                regex.append(".*")
+                i += 2
+                continue
+            if "*" == c:
+                regex.append("[^/]*")
+                while i + 1 < len(glob) and "*" == glob[i + 1]:
+                    i += 1
+            elif "?" == c:
+                regex.append("[^/]")
+            elif "[" == c and "]" in glob[i + 2:]:
+                end = glob.index("]", i + 2)
+                characters = glob[i + 1:end]
+                if characters.startswith("!"):
+                    characters = "^" + characters[1:]
+                regex.append("[" + characters.replace("\\", "\\\\") + "]")
+                i = end
+            elif "\\" == c and i + 1 < len(glob):
+                i += 1
+                regex.append(re.escape(glob[i]))
+            else:
+                regex.append(re.escape(c))
+            i += 1
+        return "".join(regex)
+
+    def match(self, relative_path: str, is_directory: bool) -> Optional[bool]:
+        for regex, is_negated, is_directory_only in self.groups:
+            if (is_directory or not is_directory_only) and regex.fullmatch(relative_path):
+                return not is_negated
+        return None
+
+
+class WitIgnore(object):
+    def __init__(self, root_path: str):
+        self.root_path = root_path
+        # Every ignore file is read and compiled once, the first time a path below its directory is checked
+        self._rules = {}  # type: Dict[str, Optional[WitIgnoreRules]]
+
+    def _get_rules(self, relative_directory: str) -> Optional[WitIgnoreRules]:
+        if relative_directory not in self._rules:
+            rules = None
+            try:
+                with open(os.path.join(self.root_path, relative_directory, WIT_IGNORE_FILE_NAME), encoding="utf8") as f:
+                    rules = WitIgnoreRules(f.readlines())
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            self._rules[relative_directory] = rules
+        return self._rules[relative_directory]
+
+    def is_ignored(self, relative_path: str, is_directory: bool) -> bool:
+        # Assumes the parent directories are not ignored, as during a walk that does not descend into ignored ones
+        relative_directory = os.path.dirname(relative_path)
+        directory = relative_directory
+        while True:
+            rules = self._get_rules(directory)
+            if rules is not None:
+                path_in_directory = relative_path[len(directory) + 1:] if directory else relative_path
+                is_ignored = rules.match(path_in_directory.replace(os.sep, "/"), is_directory)
+                if is_ignored is not None:
+                    return is_ignored
+            if not directory:
+                return False
+            directory = os.path.dirname(directory)
+
+    def is_path_ignored(self, relative_path: str, is_directory: bool) -> bool:
+        directory = ""
+        for name in relative_path.split(os.sep)[:-1]:
+            directory = os.path.join(directory, name)
+            if self.is_ignored(directory, True):
+                return True
+        return self.is_ignored(relative_path, is_directory)
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Dict, Iterable, NamedTuple, Optional, Set
+
+from wit_classes import write_file_atomically
+from wit_exceptions import InvalidWitIndexFormat
+from wit_objects import FILE_MODE, TREE_TYPE, WitObjectStore, WitTree
+
+INDEX_SIGNATURE = "WIT-INDEX 1"
+FSMONITOR_TOKEN_HEADER = "fsmonitor-token"
+FSMONITOR_PATH_HEADER = "fsmonitor-path"
+# A file modified within this window of being recorded may change again without its mtime changing
+RACY_INTERVAL_NS = 2 * 10 ** 9
+
+
+class WitIndexEntry(NamedTuple):
+    mode: str
+    object_id: str
+    mtime_ns: int
+    size: int
+    inode: int
+
+
+class WitIndex(object):
+    def __init__(self, index_path: str):
+        self.path = index_path
+        self.entries = {}  # type: Dict[str, WitIndexEntry]
+        # Tree ids of directories whose entries did not change since the id was computed
+        self.tree_ids = {}  # type: Dict[str, str]
+        self._directories = None  # type: Optional[Set[str]]
+        # The file system monitor token of the last full status, and the paths that were not clean at that point or
+        # had their entry changed since. Every other path matched its entry when the token was issued
+        self.fsmonitor_token = None  # type: Optional[str]
+        self.fsmonitor_paths = set()  # type: Set[str]
+        self.is_dirty = False
+        # Identifies the file that was loaded, every save replaces it with a new one
+        self._loaded_stat = None  # type: Optional[os.stat_result]
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path, "r", encoding="utf8") as f:
+            self._loaded_stat = os.fstat(f.fileno())
+            if f.readline().rstrip("\n") != INDEX_SIGNATURE:
+                raise InvalidWitIndexFormat()
+            try:
+                for line in f:
+                    header, path = line.rstrip("\n").split("\t", 1)
+                    if header.startswith(f"{TREE_TYPE} "):
+                        self.tree_ids[path] = header[len(TREE_TYPE) + 1:]
+                        continue
+                    if FSMONITOR_TOKEN_HEADER == header:
+                        self.fsmonitor_token = path
+                        continue
+                    if FSMONITOR_PATH_HEADER == header:
+                        self.fsmonitor_paths.add(path)
+                        continue
+                    mode, object_id, mtime_ns, size, inode = header.split(" ")
+                    self.entries[path] = WitIndexEntry(mode, object_id, int(mtime_ns), int(size), int(inode))
+            except ValueError:
+                raise InvalidWitIndexFormat()
+        self.is_dirty = False
+
+    def save(self):
+        lines = [f"{INDEX_SIGNATURE}\n"]
+        for path in sorted(self.entries):
+            entry = self.entries[path]
+            lines.append(f"{entry.mode} {entry.object_id} {entry.mtime_ns} {entry.size} {entry.inode}\t{path}\n")
+        for path in sorted(self.tree_ids):
+            lines.append(f"{TREE_TYPE} {self.tree_ids[path]}\t{path}\n")
+        if self.fsmonitor_token is not None:
+            lines.append(f"{FSMONITOR_TOKEN_HEADER}\t{self.fsmonitor_token}\n")
+            for path in sorted(self.fsmonitor_paths):
+                lines.append(f"{FSMONITOR_PATH_HEADER}\t{path}\n")
+        write_file_atomically(self.path, "".join(lines).encode("utf8"), 0o600)
+        self._loaded_stat = os.stat(self.path)
+        self.is_dirty = False
+
+    def is_changed_on_disk(self) -> bool:
+        try:
+            file_stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self._loaded_stat is not None
+        return self._loaded_stat is None or (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size) != \
+            (self._loaded_stat.st_ino, self._loaded_stat.st_mtime_ns, self._loaded_stat.st_size)
+
+    @staticmethod
+    def _make_entry(mode: str, object_id: str, file_stat: Optional[os.stat_result]) -> WitIndexEntry:
+        if file_stat is None or time.time_ns() - file_stat.st_mtime_ns < RACY_INTERVAL_NS:
+            # Without trustworthy stat data the file is hashed again the next time it is checked
+            return WitIndexEntry(mode, object_id, 0, -1, 0)
+        return WitIndexEntry(mode, object_id, file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+
+    def _invalidate_tree_ids(self, relative_path: str):
+        directory = relative_path
+        while directory:
+            directory = os.path.dirname(directory)
+            self.tree_ids.pop(directory, None)
+
+    def update(self, relative_path: str, object_id: str, mode: str = FILE_MODE,
+               file_stat: Optional[os.stat_result] = None):
+        entry = self.entries.get(relative_path)
+        if entry is None or entry.object_id != object_id or entry.mode != mode:
+            self._invalidate_tree_ids(relative_path)
+        if entry is None:
+            self._directories = None
+        if self.fsmonitor_token is not None:
+            self.fsmonitor_paths.add(relative_path)
+        self.entries[relative_path] = self._make_entry(mode, object_id, file_stat)
+        self.is_dirty = True
+
+    def remove(self, relative_path: str):
+        if self.entries.pop(relative_path, None) is not None:
+            self._invalidate_tree_ids(relative_path)
+            self._directories = None
+            if self.fsmonitor_token is not None:
+                self.fsmonitor_paths.add(relative_path)
+            self.is_dirty = True
+
+    def clear(self):
+        self.entries.clear()
+        self.tree_ids.clear()
+        self._directories = None
+        self.set_fsmonitor_state(None)
+        self.is_dirty = True
+
+    def is_tracked_directory(self, relative_directory: str) -> bool:
+        if self._directories is None:
+            self._directories = set()
+            for path in self.entries:
+                directory = os.path.dirname(path)
+                while directory and directory not in self._directories:
+                    self._directories.add(directory)
+                    directory = os.path.dirname(directory)
+        return relative_directory in self._directories
+
+    def set_fsmonitor_state(self, token: Optional[str], paths: Iterable[str] = ()):
+        self.fsmonitor_token = token
+        self.fsmonitor_paths = set(paths)
+        self.is_dirty = True
+
+    def set_tree_ids(self, tree_ids: Dict[str, str]):
+        self.tree_ids.update(tree_ids)
+        self.is_dirty = True
+
+    @staticmethod
+    def is_stat_clean(entry: WitIndexEntry, file_stat: os.stat_result) -> bool:
+        return (entry.mtime_ns == file_stat.st_mtime_ns and entry.size == file_stat.st_size
+                and entry.inode == file_stat.st_ino)
+
+    def get_object_id(self, relative_path: str, absolute_path: str, file_stat: os.stat_result) -> str:
+        entry = self.entries.get(relative_path)
+        if entry is not None and self.is_stat_clean(entry, file_stat):
+            return entry.object_id
+        object_id = WitObjectStore.hash_file(absolute_path)
+        if entry is not None and entry.object_id == object_id:
+            refreshed_entry = self._make_entry(entry.mode, object_id, file_stat)
+            if refreshed_entry != entry:
+                self.entries[relative_path] = refreshed_entry
+                self.is_dirty = True
+        return object_id
+
+    def get_tree(self, store: WitObjectStore, write: bool = False) -> WitTree:
+        tree_ids = {}  # type: Dict[str, str]
+        entries = {path: (entry.mode, entry.object_id) for path, entry in self.entries.items()}
+        tree = WitTree.from_entries(store, entries, write, tree_ids)
+        self.set_tree_ids(tree_ids)
+        return tree
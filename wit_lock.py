@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Optional
+
+from wit_exceptions import WitRepositoryLocked
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+LOCK_TIMEOUT_ENVIRONMENT_VARIABLE = "WIT_LOCK_TIMEOUT"
+# Seconds a command waits for another one to finish with the repository before giving up
+DEFAULT_LOCK_TIMEOUT = 60.0
+LOCK_POLL_INTERVAL = 0.05
+
+
+def get_lock_timeout() -> float:
+    try:
+        return max(0.0, float(os.environ[LOCK_TIMEOUT_ENVIRONMENT_VARIABLE]))
+    except (KeyError, ValueError):
+        return DEFAULT_LOCK_TIMEOUT
+
+
+class WitRepositoryLock(object):
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        self.path = path
+        self.timeout = timeout if timeout is not None else get_lock_timeout()
+        self._fd = None  # type: Optional[int]
+        self._depth = 0
+
+    def _try_lock(self) -> Optional[int]:
+        if fcntl is not None:
+            # A lock held with flock goes away with the process holding it, a killed command leaves nothing behind
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            return fd
+        try:
+            return os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return None
+
+    def try_acquire(self) -> bool:
+        if 0 == self._depth:
+            self._fd = self._try_lock()
+            if self._fd is None:
+                return False
+        self._depth += 1
+        return True
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                raise WitRepositoryLocked(self.path)
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self):
+        if 0 == self._depth:
+            return
+        self._depth -= 1
+        if 0 == self._depth:
+            os.close(self._fd)
+            self._fd = None
+            if fcntl is None:
+                os.remove(self.path)
+
+    def is_locked(self) -> bool:
+        return 0 < self._depth
+
+    def __enter__(self) -> WitRepositoryLock:
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
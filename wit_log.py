@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import sys
+from typing import Dict, List, Optional, TextIO, TYPE_CHECKING
+
+from wit_classes import discard_output
+
+if TYPE_CHECKING:
+    from wit import Wit
+    from wit_argparse import WitArguments
+    from wit_commit import WitCommit
+
+
+class WitLog(object):
+    def __init__(self, wit: Wit):
+        self.wit = wit
+
+    def _get_reference_names(self) -> Dict[str, List[str]]:
+        reference_names = {}  # type: Dict[str, List[str]]
+        for name, commit_id in self.wit.references.items():
+            reference_names.setdefault(commit_id, []).append(name)
+        return reference_names
+
+    @staticmethod
+    def _format_commit(commit: WitCommit, names: List[str]) -> str:
+        decoration = f" ({', '.join(names)})" if names else ""
+        commit_file = commit.commit_file
+        message = "".join(f"    {line}\n" for line in commit_file.get_message().splitlines())
+        return f"commit {commit.commit_id}{decoration}\nDate:   {commit_file[commit_file.DATE_KEY]}\n\n{message}\n"
+
+    def write_log(self, output: TextIO, limit: Optional[int] = None):
+        reference_names = self._get_reference_names()
+        head_id = self.wit.references.get_head()
+        try:
+            # Every commit is written as soon as it is read, so the first ones show up without waiting for the walk
+            for commit in self.wit.commits.iter_ancestors(head_id, limit):
+                output.write(self._format_commit(commit, reference_names.get(commit.commit_id, [])))
+                output.flush()
+        except BrokenPipeError:
+            discard_output(output)
+
+    def log(self, arguments: WitArguments):
+        self.write_log(sys.stdout, arguments.max_count)
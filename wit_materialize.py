@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import errno
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+MATERIALIZATION_ENVIRONMENT_VARIABLE = "WIT_MATERIALIZATION"
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+COPY_FILE_RANGE_CHUNK_SIZE = 1 << 30
+# Errors meaning the strategy does not work between these two file systems, rather than a real I/O failure
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS, errno.EINVAL, errno.ENOTTY,
+                      errno.EPERM, errno.EMLINK}
+
+
+class WitMaterializer(object):
+    name = ""
+
+    def is_available(self) -> bool:
+        return True
+
+    def materialize(self, src_path: str, dst_path: str) -> None:
+        raise NotImplementedError()
+
+
+class WitHardlinkMaterializer(WitMaterializer):
+    name = "hardlink"
+
+    def materialize(self, src_path: str, dst_path: str) -> None:
+        os.link(src_path, dst_path)
+
+
+class WitReflinkMaterializer(WitMaterializer):
+    name = "reflink"
+
+    def is_available(self) -> bool:
+        return fcntl is not None
+
+    def materialize(self, src_path: str, dst_path: str) -> None:
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(dst_path)
+                raise
+
+
+class WitCopyFileRangeMaterializer(WitMaterializer):
+    name = "copy_file_range"
+
+    def is_available(self) -> bool:
+        return hasattr(os, "copy_file_range")
+
+    def materialize(self, src_path: str, dst_path: str) -> None:
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            try:
+                while 0 < os.copy_file_range(src.fileno(), dst.fileno(), COPY_FILE_RANGE_CHUNK_SIZE):
+                    pass
+            except OSError:
+                dst.close()
+                os.remove(dst_path)
+                raise
+
+
+class WitCopyMaterializer(WitMaterializer):
+    name = "copy"
+
+    def materialize(self, src_path: str, dst_path: str) -> None:
+        shutil.copyfile(src_path, dst_path)
+
+
+MATERIALIZERS = [WitHardlinkMaterializer(), WitReflinkMaterializer(), WitCopyFileRangeMaterializer(),
+                 WitCopyMaterializer()]  # type: List[WitMaterializer]
+
+
+class WitMaterialization(object):
+    def __init__(self, materializers: Optional[List[WitMaterializer]] = None):
+        if materializers is None:
+            materializers = self._get_configured_materializers()
+        self.materializers = [materializer for materializer in materializers if materializer.is_available()]
+        # Strategies that failed between a pair of devices are not tried again for that pair
+        self._unsupported = {}  # type: Dict[Tuple[int, int], Set[str]]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_configured_materializers() -> List[WitMaterializer]:
+        names = os.environ.get(MATERIALIZATION_ENVIRONMENT_VARIABLE)
+        if not names:
+            return MATERIALIZERS
+        wanted = names.split(",")
+        return [materializer for materializer in MATERIALIZERS if materializer.name in wanted] + [MATERIALIZERS[-1]]
+
+    def _get_devices(self, src_path: str, dst_path: str) -> Tuple[int, int]:
+        return os.stat(src_path).st_dev, os.stat(os.path.dirname(dst_path) or ".").st_dev
+
+    def materialize(self, src_path: str, dst_path: str, allow_hardlink: bool = False) -> str:
+        # A hardlinked destination shares its inode with the source, so it is replaced rather than written through
+        if os.path.lexists(dst_path):
+            os.remove(dst_path)
+        devices = self._get_devices(src_path, dst_path)
+        with self._lock:
+            unsupported = set(self._unsupported.get(devices, ()))
+        for materializer in self.materializers:
+            if materializer.name in unsupported or (isinstance(materializer, WitHardlinkMaterializer)
+                                                    and not allow_hardlink):
+                continue
+            try:
+                materializer.materialize(src_path, dst_path)
+                return materializer.name
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS or isinstance(materializer, WitCopyMaterializer):
+                    raise
+                with self._lock:
+                    self._unsupported.setdefault(devices, set()).add(materializer.name)
+        raise OSError(errno.ENOTSUP, "No materialization strategy succeeded", dst_path)
+
+
+_materialization = None  # type: Optional[WitMaterialization]
+
+
+def get_materialization() -> WitMaterialization:
+    global _materialization
+    if _materialization is None:
+        _materialization = WitMaterialization()
+    return _materialization
+
+
+def materialize_file(src_path: str, dst_path: str, allow_hardlink: bool = False) -> str:
+    return get_materialization().materialize(src_path, dst_path, allow_hardlink)
@@ -0,0 +1,446 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import mmap
+import os
+import stat
+import tempfile
+from typing import BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from wit_chunking import get_chunking_threshold, iter_chunks
+from wit_consts import CHUNKED_DIRECTORY_NAME, PACK_DIRECTORY_NAME, WIT_DIRECTORY_NAME
+from wit_exceptions import InvalidWitObjectFormat, WitObjectNotFoundException
+from wit_materialize import materialize_file, WitHardlinkMaterializer
+from wit_pack import WitPacks
+from wit_parallel import WitExecutor
+
+BLOB_TYPE = "blob"
+TREE_TYPE = "tree"
+COMMIT_TYPE = "commit"
+CHUNK_TYPE = "chunk"
+FILE_MODE = "100644"
+EXECUTABLE_FILE_MODE = "100755"
+TREE_MODE = "040000"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+WitFileEntry = Tuple[str, str]  # (mode, blob_id)
+WitTreeEntry = Tuple[str, str, str]  # (mode, object_type, object_id)
+WitChunk = Tuple[str, int]  # (chunk_id, size)
+
+
+def read_file_head(path: str, size: int) -> bytes:
+    # Only the pages holding the first size bytes are mapped and read, however large the file is
+    with open(path, "rb") as f:
+        length = min(size, os.fstat(f.fileno()).st_size)
+        if 0 == length:
+            return b""
+        with mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ) as m:
+            return m[:length]
+
+
+def get_file_mode(file_stat: os.stat_result) -> str:
+    if file_stat.st_mode & stat.S_IXUSR:
+        return EXECUTABLE_FILE_MODE
+    return FILE_MODE
+
+
+class WitFileReference(NamedTuple):
+    # Either a plain file, or an object of the store at path. Plain tuples can be handed to worker processes
+    path: str
+    object_id: Optional[str] = None
+
+    def open(self) -> BinaryIO:
+        if self.object_id is None:
+            return open(self.path, "rb")
+        return get_object_store(self.path).open_object(self.object_id)
+
+    def get_size(self) -> int:
+        if self.object_id is None:
+            return os.path.getsize(self.path)
+        return get_object_store(self.path).get_object_size(self.object_id)
+
+    def read_head(self, size: int) -> bytes:
+        if self.object_id is None:
+            return read_file_head(self.path, size)
+        return get_object_store(self.path).read_object_head(self.object_id, size)
+
+    def get_object_id(self) -> str:
+        if self.object_id is None:
+            return WitObjectStore.hash_file(self.path)
+        return self.object_id
+
+
+class WitBlockReader(io.RawIOBase):
+    def __init__(self, blocks: Iterator[bytes]):
+        super().__init__()
+        self._blocks = blocks
+        self._block = b""
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self._position == len(self._block):
+            self._block = next(self._blocks, None)
+            self._position = 0
+            if self._block is None:
+                self._block = b""
+                return 0
+        size = min(len(buffer), len(self._block) - self._position)
+        buffer[:size] = self._block[self._position:self._position + size]
+        self._position += size
+        return size
+
+
+class WitObjectStore(object):
+    def __init__(self, objects_path: str, chunking_threshold: Optional[int] = None):
+        self.path = objects_path
+        self.packs = WitPacks(os.path.join(objects_path, PACK_DIRECTORY_NAME))
+        # Blobs of at least this size are stored as a list of content-defined chunks, each chunk an object of its own
+        self.chunking_threshold = chunking_threshold if chunking_threshold is not None else get_chunking_threshold()
+
+    @staticmethod
+    def _get_header(object_type: str, size: int) -> bytes:
+        return f"{object_type} {size}\0".encode()
+
+    @classmethod
+    def hash_bytes(cls, object_type: str, data: bytes) -> str:
+        sha = hashlib.sha1(cls._get_header(object_type, len(data)))
+        sha.update(data)
+        return sha.hexdigest()
+
+    @classmethod
+    def hash_file(cls, path: str) -> str:
+        with open(path, "rb") as f:
+            sha = hashlib.sha1(cls._get_header(BLOB_TYPE, os.fstat(f.fileno()).st_size))
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def get_object_path(self, object_id: str) -> str:
+        return os.path.join(self.path, object_id[:2], object_id[2:])
+
+    def has_loose_object(self, object_id: str) -> bool:
+        return os.path.exists(self.get_object_path(object_id))
+
+    def get_chunk_list_path(self, object_id: str) -> str:
+        return os.path.join(self.path, CHUNKED_DIRECTORY_NAME, object_id[:2], object_id[2:])
+
+    def has_object(self, object_id: str) -> bool:
+        return (self.has_loose_object(object_id) or os.path.exists(self.get_chunk_list_path(object_id))
+                or self.packs.has(object_id))
+
+    def iter_loose_objects(self) -> Iterator[str]:
+        if not os.path.isdir(self.path):
+            return
+        for directory_name in sorted(os.listdir(self.path)):
+            directory_path = os.path.join(self.path, directory_name)
+            if 2 != len(directory_name) or not os.path.isdir(directory_path):
+                continue
+            for file_name in sorted(os.listdir(directory_path)):
+                if 38 == len(file_name):  # Skips temporary files of objects being written
+                    yield directory_name + file_name
+
+    def remove_loose_object(self, object_id: str) -> None:
+        object_path = self.get_object_path(object_id)
+        os.remove(object_path)
+        try:
+            os.rmdir(os.path.dirname(object_path))
+        except OSError:  # The directory still holds other objects
+            pass
+
+    def _store(self, object_id: str, write_to: Callable[[BinaryIO], object], object_path: Optional[str] = None) -> None:
+        if object_path is None:
+            object_path = self.get_object_path(object_id)
+        object_directory = os.path.dirname(object_path)
+        os.makedirs(object_directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=object_directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write_to(f)
+            os.replace(temp_path, object_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def write_object(self, object_type: str, data: bytes) -> str:
+        object_id = self.hash_bytes(object_type, data)
+        if not self.has_object(object_id):
+            self._store(object_id, lambda f: f.write(data))
+        return object_id
+
+    def _store_file(self, object_id: str, path: str, allow_hardlink: bool) -> str:
+        object_path = self.get_object_path(object_id)
+        object_directory = os.path.dirname(object_path)
+        os.makedirs(object_directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=object_directory)
+        os.close(fd)
+        try:
+            if WitHardlinkMaterializer.name != materialize_file(path, temp_path, allow_hardlink):
+                # The file may have changed since it was hashed, the copy is what gets stored so its id is what counts
+                copied_id = self.hash_file(temp_path)
+                if copied_id != object_id:
+                    object_id, object_path = copied_id, self.get_object_path(copied_id)
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(temp_path, object_path)
+        except BaseException:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            raise
+        return object_id
+
+    def _store_chunked_file(self, path: str) -> str:
+        # Chunks already stored for another file or version are not written again. The file may have changed since
+        # it was hashed, so the id is computed from the chunks as they are stored
+        chunks = []  # type: List[WitChunk]
+        with open(path, "rb") as f:
+            expected_size = os.fstat(f.fileno()).st_size
+            sha = hashlib.sha1(self._get_header(BLOB_TYPE, expected_size))
+            for chunk in iter_chunks(f):
+                sha.update(chunk)
+                chunks.append((self.write_object(CHUNK_TYPE, chunk), len(chunk)))
+        size = sum(chunk_size for _, chunk_size in chunks)
+        if size != expected_size:  # The header went into the hash first, it is hashed again with the real size
+            sha = hashlib.sha1(self._get_header(BLOB_TYPE, size))
+            for chunk_id, _ in chunks:
+                sha.update(self.read_object(chunk_id))
+        object_id = sha.hexdigest()
+        if not self.has_object(object_id):
+            lines = "".join(f"{chunk_id} {chunk_size}\n" for chunk_id, chunk_size in chunks).encode()
+            self._store(object_id, lambda f: f.write(lines), self.get_chunk_list_path(object_id))
+        return object_id
+
+    def write_blob_from_file(self, path: str, allow_hardlink: bool = False) -> str:
+        blob_id = self.hash_file(path)
+        if not self.has_object(blob_id):
+            if os.path.getsize(path) >= self.chunking_threshold:
+                blob_id = self._store_chunked_file(path)
+            else:
+                blob_id = self._store_file(blob_id, path, allow_hardlink)
+        return blob_id
+
+    def _read_chunk_list(self, object_id: str) -> Optional[List[WitChunk]]:
+        try:
+            with open(self.get_chunk_list_path(object_id), "r") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+        try:
+            return [(chunk_id, int(size)) for chunk_id, size in (line.split(" ") for line in lines)]
+        except ValueError:
+            raise InvalidWitObjectFormat(object_id)
+
+    def iter_object_blocks(self, object_id: str) -> Iterator[bytes]:
+        try:
+            f = open(self.get_object_path(object_id), "rb")
+        except FileNotFoundError:
+            pass
+        else:
+            with f:
+                yield from iter(lambda: f.read(HASH_BLOCK_SIZE), b"")
+            return
+        chunks = self._read_chunk_list(object_id)
+        if chunks is not None:
+            for chunk_id, _ in chunks:
+                yield self.read_object(chunk_id)
+            return
+        data = self.packs.read(object_id)
+        if data is None:
+            raise WitObjectNotFoundException(object_id)
+        yield data
+
+    def read_object(self, object_id: str) -> bytes:
+        return b"".join(self.iter_object_blocks(object_id))
+
+    def read_object_head(self, object_id: str, size: int) -> bytes:
+        try:
+            return read_file_head(self.get_object_path(object_id), size)
+        except FileNotFoundError:
+            pass
+        chunks = self._read_chunk_list(object_id)
+        if chunks is not None:
+            data = b""
+            for chunk_id, _ in chunks:
+                if len(data) >= size:
+                    break
+                data += self.read_object_head(chunk_id, size - len(data))
+            return data
+        data = self.packs.read_head(object_id, size)
+        if data is None:
+            raise WitObjectNotFoundException(object_id)
+        return data
+
+    def open_object(self, object_id: str) -> BinaryIO:
+        try:
+            return open(self.get_object_path(object_id), "rb")
+        except FileNotFoundError:
+            pass
+        if not self.has_object(object_id):
+            raise WitObjectNotFoundException(object_id)
+        # Chunked objects are read one chunk at a time
+        return io.BufferedReader(WitBlockReader(self.iter_object_blocks(object_id)))
+
+    def get_object_size(self, object_id: str) -> int:
+        try:
+            return os.path.getsize(self.get_object_path(object_id))
+        except FileNotFoundError:
+            pass
+        chunks = self._read_chunk_list(object_id)
+        if chunks is not None:
+            return sum(size for _, size in chunks)
+        size = self.packs.get_size(object_id)
+        if size is None:
+            raise WitObjectNotFoundException(object_id)
+        return size
+
+    def copy_blob_to(self, blob_id: str, dst_path: str, mode: str = FILE_MODE, allow_hardlink: bool = False) -> None:
+        if not self.has_object(blob_id):
+            raise WitObjectNotFoundException(blob_id)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        if self.has_loose_object(blob_id):
+            if WitHardlinkMaterializer.name == materialize_file(self.get_object_path(blob_id), dst_path,
+                                                                allow_hardlink):
+                return
+        else:
+            # Packed and chunked objects have no file of their own to link or clone, so their contents are streamed
+            if os.path.lexists(dst_path):
+                os.remove(dst_path)
+            with open(dst_path, "wb") as f:
+                f.writelines(self.iter_object_blocks(blob_id))
+        os.chmod(dst_path, 0o755 if EXECUTABLE_FILE_MODE == mode else 0o644)
+
+
+_object_stores = {}  # type: Dict[str, WitObjectStore]
+
+
+def get_object_store(objects_path: str) -> WitObjectStore:
+    # Shared per path, so that the pack indexes are mapped once per process rather than once per file
+    if objects_path not in _object_stores:
+        _object_stores[objects_path] = WitObjectStore(objects_path)
+    return _object_stores[objects_path]
+
+
+class WitTree(object):
+    def __init__(self, store: WitObjectStore, tree_id: Optional[str] = None):
+        self.store = store
+        self.tree_id = tree_id
+        self.children = {}  # type: Dict[str, WitTreeEntry]
+        self._subtrees = {}  # type: Dict[str, WitTree]
+        if tree_id is not None:
+            self.load()
+
+    @classmethod
+    def from_entries(cls, store: WitObjectStore, entries: Dict[str, WitFileEntry], write: bool = False,
+                     tree_ids: Optional[Dict[str, str]] = None) -> WitTree:
+        root = cls(store)
+        for path, (mode, blob_id) in entries.items():
+            tree = root
+            *directory_names, file_name = path.split(os.sep)
+            for name in directory_names:
+                if name not in tree._subtrees:
+                    tree._subtrees[name] = cls(store)
+                tree = tree._subtrees[name]
+            tree.children[file_name] = (mode, BLOB_TYPE, blob_id)
+        root._seal("", write, tree_ids)
+        return root
+
+    def _seal(self, path: str, write: bool, tree_ids: Optional[Dict[str, str]]):
+        for name, subtree in self._subtrees.items():
+            subtree._seal(os.path.join(path, name), write, tree_ids)
+            self.children[name] = (TREE_MODE, TREE_TYPE, subtree.tree_id)
+        if write:
+            self.tree_id = self.store.write_object(TREE_TYPE, self._serialize())
+        else:
+            self.tree_id = self.store.hash_bytes(TREE_TYPE, self._serialize())
+        if tree_ids is not None:
+            tree_ids[path] = self.tree_id
+
+    @staticmethod
+    def _list_directory_files(directory_path: str) -> Iterator[str]:
+        for curr_dir, dir_names, file_names in os.walk(directory_path):
+            if WIT_DIRECTORY_NAME in dir_names:  # Skip the '.wit' directory itself
+                dir_names.remove(WIT_DIRECTORY_NAME)
+            for file_name in file_names:
+                yield os.path.join(curr_dir, file_name)
+
+    @classmethod
+    def from_directory(cls, store: WitObjectStore, directory_path: str, write: bool = True) -> WitTree:
+        def hash_file(absolute_path: str) -> Tuple[str, str, str]:
+            if write:
+                blob_id = store.write_blob_from_file(absolute_path)
+            else:
+                blob_id = store.hash_file(absolute_path)
+            return os.path.relpath(absolute_path, directory_path), get_file_mode(os.stat(absolute_path)), blob_id
+
+        entries = {}  # type: Dict[str, WitFileEntry]
+        for relative_path, mode, blob_id in WitExecutor().map(hash_file, cls._list_directory_files(directory_path)):
+            entries[relative_path] = (mode, blob_id)
+        return cls.from_entries(store, entries, write)
+
+    def _serialize(self) -> bytes:
+        lines = []
+        for name in sorted(self.children):
+            mode, object_type, object_id = self.children[name]
+            lines.append(f"{mode} {object_type} {object_id}\t{name}\n")
+        return "".join(lines).encode()
+
+    def load(self):
+        data = self.store.read_object(self.tree_id)
+        try:
+            for line in data.decode().splitlines():
+                header, name = line.split("\t", 1)
+                mode, object_type, object_id = header.split(" ")
+                self.children[name] = (mode, object_type, object_id)
+        except ValueError:
+            raise InvalidWitObjectFormat(self.tree_id)
+        if any(os.sep in name for name in self.children):
+            # Trees written before subdirectories got their own tree objects list every file by its full path
+            flat_entries = {path: (mode, object_id) for path, (mode, _, object_id) in self.children.items()}
+            nested_tree = self.from_entries(self.store, flat_entries, write=True)
+            self.children = nested_tree.children
+            self._subtrees = nested_tree._subtrees
+
+    def get_subtree(self, name: str) -> WitTree:
+        if name not in self._subtrees:
+            mode, object_type, object_id = self.children[name]
+            if TREE_TYPE != object_type:
+                raise NotADirectoryError(name)
+            self._subtrees[name] = WitTree(self.store, object_id)
+        return self._subtrees[name]
+
+    def get_directory(self, relative_directory: str) -> Optional[WitTree]:
+        tree = self
+        for name in filter(None, relative_directory.split(os.sep)):
+            entry = tree.children.get(name)
+            if entry is None or TREE_TYPE != entry[1]:
+                return None
+            tree = tree.get_subtree(name)
+        return tree
+
+    def get_entry(self, relative_path: str) -> Optional[WitTreeEntry]:
+        directory, name = os.path.split(relative_path)
+        tree = self.get_directory(directory)
+        if tree is None:
+            return None
+        return tree.children.get(name)
+
+    def iter_files(self, relative_directory: str = "") -> Iterator[Tuple[str, WitFileEntry]]:
+        for name in sorted(self.children):
+            mode, object_type, object_id = self.children[name]
+            path = os.path.join(relative_directory, name)
+            if TREE_TYPE == object_type:
+                yield from self.get_subtree(name).iter_files(path)
+            else:
+                yield path, (mode, object_id)
+
+    def get_file_reference(self, relative_path: str) -> WitFileReference:
+        return WitFileReference(self.store.path, self.get_entry(relative_path)[2])
+
+    def is_same(self, other: WitTree) -> bool:
+        return self.tree_id == other.tree_id
+
+    def copy_file_to(self, directory_path: str, relative_path: str, allow_hardlink: bool = False) -> None:
+        mode, _, blob_id = self.get_entry(relative_path)
+        self.store.copy_blob_to(blob_id, os.path.join(directory_path, relative_path), mode, allow_hardlink)
@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from wit_classes import fsync_directory
+from wit_exceptions import InvalidWitPackFormat
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+PACK_SIGNATURE = b"WPCK"
+INDEX_SIGNATURE = b"WIDX"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct(">4sII")  # (signature, version, object_count)
+RECORD_HEADER = struct.Struct(">BQI")  # (kind, object_size, payload_size)
+INDEX_OFFSET = struct.Struct(">Q")
+FULL_RECORD = 0
+DELTA_RECORD = 1
+RAW_ID_SIZE = 20
+FANOUT_SIZE = 256 * 4
+# Reading an object walks its delta chain, so chains are cut by storing a full object every this many versions
+MAXIMUM_DELTA_DEPTH = 50
+COMPRESSION_LEVEL = 9
+
+# A delta only has to be small, not minimal, so its line search stops early. Past this many edits a range is split at
+# the furthest point reached, which keeps heavily changed files of repeating lines close to linear time
+DELTA_MAXIMUM_COST = 16
+# Targets with fewer of their lines in the base than this are stored whole without searching for matches at all, and
+# so are those with less of their bytes copied from the base than this once the search is done
+MINIMUM_SHARED_LINE_RATIO = 0.5
+
+COPY_OPERATION = 1
+INSERT_OPERATION = 2
+COPY_HEADER = struct.Struct(">BQQ")  # (operation, offset, size)
+INSERT_HEADER = struct.Struct(">BQ")  # (operation, size)
+
+
+def make_delta(base: bytes, target: bytes) -> Optional[bytes]:
+    # Lines are matched like in a diff, every matching run becomes a copy from the base and the rest is inserted.
+    # None when the target is mostly new lines, a delta of it could not be much smaller than the object itself.
+    # Imported here, as only gc writes deltas while every command reads through the store
+    from wit_diff_algorithms import hash_lines, myers_matching_blocks
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    base_line_set = set(base_lines)
+    if sum(1 for line in target_lines if line in base_line_set) < MINIMUM_SHARED_LINE_RATIO * len(target_lines):
+        return None
+    base_offsets = [0]
+    for line in base_lines:
+        base_offsets.append(base_offsets[-1] + len(line))
+    target_offsets = [0]
+    for line in target_lines:
+        target_offsets.append(target_offsets[-1] + len(line))
+    operations = []
+    target_position = 0
+    copied_size = 0
+    for base_start, target_start, length in myers_matching_blocks(*hash_lines(base_lines, target_lines),
+                                                                  maximum_cost=DELTA_MAXIMUM_COST):
+        if target_position < target_offsets[target_start]:
+            data = target[target_position:target_offsets[target_start]]
+            operations.append(INSERT_HEADER.pack(INSERT_OPERATION, len(data)) + data)
+        offset = base_offsets[base_start]
+        size = base_offsets[base_start + length] - offset
+        operations.append(COPY_HEADER.pack(COPY_OPERATION, offset, size))
+        copied_size += size
+        target_position = target_offsets[target_start + length]
+    if copied_size < MINIMUM_SHARED_LINE_RATIO * len(target):  # The search ended early on too much of it
+        return None
+    if target_position < len(target):
+        data = target[target_position:]
+        operations.append(INSERT_HEADER.pack(INSERT_OPERATION, len(data)) + data)
+    return b"".join(operations)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    parts = []
+    position = 0
+    while position < len(delta):
+        if COPY_OPERATION == delta[position]:
+            _, offset, size = COPY_HEADER.unpack_from(delta, position)
+            position += COPY_HEADER.size
+            parts.append(base[offset:offset + size])
+        elif INSERT_OPERATION == delta[position]:
+            _, size = INSERT_HEADER.unpack_from(delta, position)
+            position += INSERT_HEADER.size
+            parts.append(delta[position:position + size])
+            position += size
+        else:
+            raise InvalidWitPackFormat(f"Unknown delta operation {delta[position]}")
+    return b"".join(parts)
+
+
+class WitPack(object):
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.pack_path = index_path[:-len(INDEX_SUFFIX)] + PACK_SUFFIX
+        with open(self.index_path, "rb") as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.pack_path, "rb") as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, self.count = PACK_HEADER.unpack_from(self._index, 0)
+        if INDEX_SIGNATURE != signature or PACK_VERSION != version:
+            raise InvalidWitPackFormat(self.index_path)
+        self._fanout = struct.unpack_from(">256I", self._index, PACK_HEADER.size)
+        self._ids_start = PACK_HEADER.size + FANOUT_SIZE
+        self._offsets_start = self._ids_start + self.count * RAW_ID_SIZE
+
+    def _get_raw_id(self, position: int) -> bytes:
+        start = self._ids_start + position * RAW_ID_SIZE
+        return self._index[start:start + RAW_ID_SIZE]
+
+    def find(self, object_id: str) -> Optional[int]:
+        # The fanout table narrows the search to the ids sharing the first byte, a binary search does the rest
+        try:
+            raw_id = bytes.fromhex(object_id)
+        except ValueError:
+            return None
+        low = self._fanout[raw_id[0] - 1] if raw_id[0] else 0
+        high = self._fanout[raw_id[0]]
+        while low < high:
+            middle = (low + high) // 2
+            middle_id = self._get_raw_id(middle)
+            if middle_id < raw_id:
+                low = middle + 1
+            elif middle_id > raw_id:
+                high = middle
+            else:
+                return INDEX_OFFSET.unpack_from(self._index, self._offsets_start + middle * INDEX_OFFSET.size)[0]
+        return None
+
+    def __contains__(self, object_id: str) -> bool:
+        return self.find(object_id) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for position in range(self.count):
+            yield self._get_raw_id(position).hex()
+
+    def get_size(self, offset: int) -> int:
+        return RECORD_HEADER.unpack_from(self._pack, offset)[1]
+
+    def read_record(self, offset: int, maximum_size: int = 0) -> Tuple[int, Optional[str], bytes]:
+        # A full record can be read only up to maximum_size, a delta is always read whole
+        kind, _, payload_size = RECORD_HEADER.unpack_from(self._pack, offset)
+        position = offset + RECORD_HEADER.size
+        base_id = None
+        if DELTA_RECORD == kind:
+            base_id = self._pack[position:position + RAW_ID_SIZE].hex()
+            position += RAW_ID_SIZE
+            maximum_size = 0
+        return kind, base_id, zlib.decompressobj().decompress(self._pack[position:position + payload_size],
+                                                              maximum_size)
+
+    def close(self):
+        self._index.close()
+        self._pack.close()
+
+
+class WitPacks(object):
+    def __init__(self, pack_directory_path: str):
+        self.path = pack_directory_path
+        self._packs = None  # type: Optional[List[WitPack]]
+        self._lock = threading.Lock()
+
+    def _get_packs(self) -> List[WitPack]:
+        if self._packs is None:
+            with self._lock:
+                if self._packs is None:
+                    packs = []
+                    if os.path.isdir(self.path):
+                        # The index is written last, a pack without one is not complete yet
+                        for file_name in sorted(os.listdir(self.path)):
+                            if file_name.endswith(INDEX_SUFFIX):
+                                packs.append(WitPack(os.path.join(self.path, file_name)))
+                    self._packs = packs
+        return self._packs
+
+    def reload(self):
+        with self._lock:
+            if self._packs is not None:
+                for pack in self._packs:
+                    pack.close()
+            self._packs = None
+
+    def _find(self, object_id: str) -> Optional[Tuple[WitPack, int]]:
+        for pack in self._get_packs():
+            offset = pack.find(object_id)
+            if offset is not None:
+                return pack, offset
+        return None
+
+    def has(self, object_id: str) -> bool:
+        return self._find(object_id) is not None
+
+    def get_size(self, object_id: str) -> Optional[int]:
+        location = self._find(object_id)
+        if location is None:
+            return None
+        pack, offset = location
+        return pack.get_size(offset)
+
+    def read_head(self, object_id: str, size: int) -> Optional[bytes]:
+        location = self._find(object_id)
+        if location is None:
+            return None
+        pack, offset = location
+        kind, _, data = pack.read_record(offset, size)
+        if FULL_RECORD == kind:
+            return data
+        return self.read(object_id)[:size]
+
+    def read(self, object_id: str) -> Optional[bytes]:
+        location = self._find(object_id)
+        if location is None:
+            return None
+        # Deltas are resolved from the base up, the chain length is bounded by MAXIMUM_DELTA_DEPTH
+        deltas = []
+        while True:
+            pack, offset = location
+            kind, base_id, data = pack.read_record(offset)
+            if FULL_RECORD == kind:
+                break
+            deltas.append(data)
+            location = self._find(base_id)
+            if location is None:
+                raise InvalidWitPackFormat(f"Missing delta base {base_id}")
+        for delta in reversed(deltas):
+            data = apply_delta(data, delta)
+        return data
+
+    def __iter__(self) -> Iterator[str]:
+        for pack in self._get_packs():
+            yield from pack
+
+    def get_pack_paths(self) -> List[str]:
+        return [path for pack in self._get_packs() for path in (pack.index_path, pack.pack_path)]
+
+
+class WitPackWriter(object):
+    def __init__(self, pack_directory_path: str, object_count: int):
+        self.path = pack_directory_path
+        os.makedirs(self.path, exist_ok=True)
+        fd, self._temp_pack_path = tempfile.mkstemp(dir=self.path)
+        self._file = os.fdopen(fd, "wb")
+        self._sha = hashlib.sha1()
+        self._offset = 0
+        self._offsets = {}  # type: Dict[bytes, int]
+        self._object_count = object_count
+        self._write(PACK_HEADER.pack(PACK_SIGNATURE, PACK_VERSION, object_count))
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self._sha.update(data)
+        self._offset += len(data)
+
+    def add(self, object_id: str, data: bytes, base_id: Optional[str] = None,
+            base_data: Optional[bytes] = None) -> bool:
+        # Returns whether the object was stored as a delta, which is done only when that is smaller
+        self._offsets[bytes.fromhex(object_id)] = self._offset
+        payload = zlib.compress(data, COMPRESSION_LEVEL)
+        delta = make_delta(base_data, data) if base_id is not None else None
+        if delta is not None:
+            delta_payload = zlib.compress(delta, COMPRESSION_LEVEL)
+            if len(delta_payload) + RAW_ID_SIZE < len(payload):
+                self._write(RECORD_HEADER.pack(DELTA_RECORD, len(data), len(delta_payload)))
+                self._write(bytes.fromhex(base_id))
+                self._write(delta_payload)
+                return True
+        self._write(RECORD_HEADER.pack(FULL_RECORD, len(data), len(payload)))
+        self._write(payload)
+        return False
+
+    def _write_index(self, index_path: str, checksum: bytes):
+        raw_ids = sorted(self._offsets)
+        fanout = [0] * 256
+        for raw_id in raw_ids:
+            fanout[raw_id[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+        fd, temp_index_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(PACK_HEADER.pack(INDEX_SIGNATURE, PACK_VERSION, len(raw_ids)))
+            f.write(struct.pack(">256I", *fanout))
+            f.writelines(raw_ids)
+            f.writelines(INDEX_OFFSET.pack(self._offsets[raw_id]) for raw_id in raw_ids)
+            f.write(checksum)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_index_path, index_path)
+
+    def finish(self) -> str:
+        if len(self._offsets) != self._object_count:
+            raise InvalidWitPackFormat(f"Expected {self._object_count} objects, got {len(self._offsets)}")
+        checksum = self._sha.digest()
+        self._file.write(checksum)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        name = f"pack-{checksum.hex()}"
+        pack_path = os.path.join(self.path, name + PACK_SUFFIX)
+        os.replace(self._temp_pack_path, pack_path)
+        self._write_index(os.path.join(self.path, name + INDEX_SUFFIX), checksum)
+        # Loose objects and older packs are removed right after this, the new pack must already be on disk by then
+        fsync_directory(self.path)
+        return pack_path
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._temp_pack_path):
+            os.remove(self._temp_pack_path)
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import collections
+import os
+from typing import Callable, Deque, Iterable, Iterator, Optional, TYPE_CHECKING, TypeVar
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+WORKERS_ENVIRONMENT_VARIABLE = "WIT_WORKERS"
+# File copies, stats and hashes wait on I/O (hashlib releases the GIL), so more threads than cores pay off
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# Bounds the number of submitted but not yet consumed tasks per worker
+PENDING_TASKS_PER_WORKER = 4
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def get_worker_count() -> int:
+    try:
+        return max(1, int(os.environ[WORKERS_ENVIRONMENT_VARIABLE]))
+    except (KeyError, ValueError):
+        return DEFAULT_WORKERS
+
+
+class WitExecutor(object):
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers if workers is not None else get_worker_count()
+
+    def map(self, function: Callable[[T], R], items: Iterable[T]) -> Iterator[R]:
+        # Results come back in the order of items, and the first failing item in that order raises its error,
+        # exactly as the sequential loop would
+        if 1 == self.workers:
+            for item in items:
+                yield function(item)
+            return
+        # Imported here, as concurrent.futures pulls in logging and threading and most commands never get here
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()  # type: Deque[Future]
+            try:
+                for item in items:
+                    pending.append(executor.submit(function, item))
+                    if len(pending) >= self.workers * PENDING_TASKS_PER_WORKER:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def run(self, function: Callable[[T], object], items: Iterable[T]) -> None:
+        for _ in self.map(function, items):
+            pass
@@ -1,40 +1,59 @@
 from __future__ import annotations
 
-from typing import List, TYPE_CHECKING
+from typing import Dict, List, TYPE_CHECKING
+
+from wit_compare import ADDED, DELETED, MODIFIED, TYPE_CHANGED, WitCompare, WitTreeSource
+from wit_fsmonitor import get_dirty_paths
 
 if TYPE_CHECKING:
     from wit import WitStagingArea
     from wit_commit import WitCommit
+    from wit_objects import WitObjectStore
 
 
 class WitStatus(object):
-    def __init__(self, head_commit: WitCommit, staging_area: WitStagingArea):
+    def __init__(self, head_commit: WitCommit, staging_area: WitStagingArea, objects: WitObjectStore):
         self.head_commit = head_commit
         self.staging_area = staging_area
+        self.staging_source = staging_area.get_source()
         self.changes_to_be_committed = self.get_changes_to_be_committed()
-        self.changes_not_staged_for_commit = self.get_changes_not_staged_for_commit()
-        self.untracked_files = self.get_untracked_files()
-        self.missing_files = self.get_missing_files()
+        self.changes_not_staged_for_commit = []  # type: List[str]
+        self.untracked_files = []  # type: List[str]
+        self.missing_files = []  # type: List[str]
+        # Kind of every change between the staging area and the working directory, for lookups by path
+        self.working_directory_changes = {}  # type: Dict[str, str]
+        self._compare_working_directory()
+        self.staging_area.save_index()
 
     def get_changes_to_be_committed(self) -> List[str]:
-        dir_cmp = self.staging_area.compare_directory(self.head_commit.commit_dir)
-        result = dir_cmp.diff_files + dir_cmp.left_only
-        return result
-
-    def get_changes_not_staged_for_commit(self) -> List[str]:
-        dir_cmp = self.staging_area.compare_directory(self.staging_area.wit_parent_directory)
-        result = dir_cmp.diff_files
-        return result
-
-    def get_untracked_files(self) -> List[str]:
-        dir_cmp = self.staging_area.compare_directory(self.staging_area.wit_parent_directory)
-        result = dir_cmp.right_only
-        return result
-
-    def get_missing_files(self) -> List[str]:
-        dir_cmp = self.staging_area.compare_directory(self.staging_area.wit_parent_directory)
-        result = dir_cmp.left_only
-        return result
+        head_source = WitTreeSource(self.head_commit.get_tree())
+        compare = WitCompare(head_source, self.staging_source)
+        return [change.path for change in compare.changes()]
+
+    def _compare_working_directory(self):
+        # With a file system monitor running only the paths it reports, and those that were not clean last time, are
+        # looked at. Any doubt about what it reports falls back to scanning the whole working directory
+        fsmonitor_response = self.staging_area.query_fsmonitor()
+        dirty_paths = None
+        if fsmonitor_response is not None:
+            dirty_paths = get_dirty_paths(fsmonitor_response, self.staging_area.index.fsmonitor_paths)
+        compare = WitCompare(self.staging_source, self.staging_area.get_working_directory_source(dirty_paths))
+        for change in compare.changes():
+            self.working_directory_changes[change.path] = change.kind
+            if MODIFIED == change.kind or TYPE_CHANGED == change.kind:
+                self.changes_not_staged_for_commit.append(change.path)
+            elif ADDED == change.kind:
+                self.untracked_files.append(change.path)
+            elif DELETED == change.kind:
+                self.missing_files.append(change.path)
+        if fsmonitor_response is not None:
+            self.staging_area.index.set_fsmonitor_state(fsmonitor_response.token, self.working_directory_changes)
+
+    def is_untracked(self, relative_path: str) -> bool:
+        return ADDED == self.working_directory_changes.get(relative_path)
+
+    def is_missing(self, relative_path: str) -> bool:
+        return DELETED == self.working_directory_changes.get(relative_path)
 
     def print_status(self):
         print(f"{self.head_commit.commit_id}")